@@ -0,0 +1,80 @@
+"""
+Consensus orientation of cube poses.
+A cube's rotation is only known up to its 24 symmetries, so rotations are compared after turning
+them by the symmetry that brings them closest to each other.
+"""
+import numpy as np
+from itertools import combinations
+
+def _cubeSymmetries():
+    axes = np.eye(3)
+    pairs = list(combinations(range(3), 2))
+    pairs += [pair[::-1] for pair in pairs]
+    flips = [(1,1), (-1,1), (1,-1), (-1,-1)]
+    return np.array([np.array([s1*axes[a], s2*axes[b], np.cross(s1*axes[a], s2*axes[b])]).T for a, b in pairs for s1, s2 in flips])
+
+# The 24 rotations of a cube, in opencv_points.get_options order so that get_options(mat) == mat @ CUBE_SYMMETRIES
+CUBE_SYMMETRIES = _cubeSymmetries()
+
+def rodriguesMatrices(rvecs):
+    """cv.Rodrigues of an (N,3) array of rotation vectors, as (N,3,3) matrices"""
+    rvecs = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3)
+    angles = np.linalg.norm(rvecs, axis=1)
+    axes = rvecs / np.where(angles > 0, angles, 1)[:, None]
+    cross = np.zeros((len(rvecs), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = -axes[:, 2], axes[:, 1], -axes[:, 0]
+    cross -= cross.transpose(0, 2, 1)
+    return np.eye(3) + np.sin(angles)[:, None, None] * cross + (1 - np.cos(angles))[:, None, None] * cross @ cross
+
+def symmetryOptions(rotations):
+    """Every (N,3,3) rotation turned by each cube symmetry, as (N,24,3,3)"""
+    return np.einsum('nij,kjl->nkil', rotations, CUBE_SYMMETRIES)
+
+def alignRotations(rotations, reference):
+    """
+    Every (N,3,3) rotation turned by the cube symmetry that brings it closest to reference.
+    Returns the turned rotations and their similarity to reference (trace(A^T B) / 3, 1 for equal rotations).
+    """
+    options = symmetryOptions(rotations)
+    scores = np.einsum('nkij,ij->nk', options, reference) / 3
+    best = np.argmax(scores, axis=1)
+    index = np.arange(len(rotations))
+    return options[index, best], scores[index, best]
+
+def chordalMean(rotations, weights = None):
+    """The rotation closest to the (weighted) sum of rotations in the Frobenius norm, their chordal L2 mean"""
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    weights = np.ones(len(rotations)) if weights is None else np.asarray(weights, dtype=np.float64)
+    U, _, Vt = np.linalg.svd(np.einsum('n,nij->ij', weights, rotations))
+    fix = np.diag([1, 1, np.sign(np.linalg.det(U @ Vt))])
+    return U @ fix @ Vt
+
+def rotationConsensus(rotations, threshold = 0.97, candidates = 32, iterations = 10):
+    """
+    Orientation most of the (N,3,3) rotations agree on, modulo the cube symmetries.
+    The medoid of up to candidates evenly spread rotations (the one with the most others within threshold) starts
+    a mean shift: the chordal mean of the rotations within threshold, realigned until the inliers settle.
+    Returns the mean, the rotations aligned to it and the mask of inliers.
+    """
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    if len(rotations) == 0:
+        return np.eye(3), rotations, np.zeros(0, dtype=bool)
+
+    options = symmetryOptions(rotations)
+    references = rotations[np.unique(np.linspace(0, len(rotations) - 1, min(candidates, len(rotations))).astype(np.int64))]
+    scores = np.einsum('nkij,cij->cnk', options, references).max(axis=2) / 3
+    within = scores > threshold
+    medoid = np.lexsort((np.where(within, scores, 0).sum(axis=1), within.sum(axis=1)))[-1]
+
+    mean, inliers = references[medoid], None
+    for _ in range(iterations):
+        aligned, similarity = alignRotations(rotations, mean)
+        new_inliers = similarity > threshold
+        if inliers is not None and np.array_equal(inliers, new_inliers):
+            break
+        inliers = new_inliers
+        if not inliers.any():
+            break
+        mean = chordalMean(aligned[inliers])
+    aligned, similarity = alignRotations(rotations, mean)
+    return mean, aligned, similarity > threshold
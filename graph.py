@@ -1,287 +1,512 @@
 import numpy as np
 import cv2 as cv
+import time
 from util import *
-from util import _segmentIntersection
-import itertools
 
 class Graph:
-    """Key methods of Graph class"""
-    def __init__(self):
+    """
+    Key methods of Graph class
+    Vertex coordinates are rows of one growable array, and edges are stored as a padded array of neighbour
+    indices per vertex (-1 marks an empty slot). Removed vertices are only marked dead: indices are never reused,
+    so vertices keep the order they were added in, like the old dict of vertices. compact() drops the dead rows.
+    copy() shares the arrays, and whichever graph is changed first makes its own copy of them.
+    """
+    __slots__ = ("_coords", "_adjacency", "_degree", "_alive", "_size", "_shared")
+
+    def __init__(self, capacity = 16, max_degree = 4):
         #list of points
-        self.vertices = dict()
-        #dictionary of out edges for each vertex
-        self.edges = dict()
-        self.max_index = -1
-        
+        self._coords = np.zeros((capacity, 2))
+        #padded out edges for each vertex
+        self._adjacency = np.full((capacity, max_degree), -1, dtype=np.int32)
+        self._degree = np.zeros(capacity, dtype=np.int32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        # Rows past _size were never used
+        self._size = 0
+        self._shared = False
+
+    def _detach(self) -> None:
+        """Copy the shared arrays before the first change after copy()"""
+        if not self._shared:
+            return
+        self._coords = self._coords.copy()
+        self._adjacency = self._adjacency.copy()
+        self._degree = self._degree.copy()
+        self._alive = self._alive.copy()
+        self._shared = False
+
+    def _reserve(self, count) -> None:
+        capacity = len(self._coords)
+        if self._size + count <= capacity:
+            return
+        capacity = max(2 * capacity, self._size + count)
+        grow = capacity - len(self._coords)
+        self._coords = np.concatenate([self._coords, np.zeros((grow, 2))])
+        self._adjacency = np.concatenate([self._adjacency, np.full((grow, self._adjacency.shape[1]), -1, dtype=np.int32)])
+        self._degree = np.concatenate([self._degree, np.zeros(grow, dtype=np.int32)])
+        self._alive = np.concatenate([self._alive, np.zeros(grow, dtype=bool)])
+
+    def _widen(self) -> None:
+        """Double the number of neighbour slots per vertex"""
+        self._adjacency = np.concatenate([self._adjacency, np.full_like(self._adjacency, -1)], axis=1)
 
     def has_vertex(self, vertex) -> bool:
-        return any([(v - vertex).dot(v - vertex) < 0.01 for v in self.vertices.values()])
-    
+        return self.get_vertex_index(vertex, threshold=0.1) is not None
+
+    def get_vertex_indices(self, vertices, threshold = 0.01) -> np.ndarray:
+        """Index of the closest vertex within threshold of each point, -1 where there is none"""
+        indices = self.vertex_indices()
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        pairs = pointPairsWithin(vertices, threshold, self._coords[indices])
+        distances = np.linalg.norm(vertices[pairs[:, 0]] - self._coords[indices[pairs[:, 1]]], axis=1)
+        pairs = pairs[np.lexsort((distances, pairs[:, 0]))]
+        closest = np.concatenate([[True], pairs[1:, 0] != pairs[:-1, 0]]) if len(pairs) else np.empty(0, dtype=bool)
+        snapped = np.full(len(vertices), -1)
+        snapped[pairs[closest, 0]] = indices[pairs[closest, 1]]
+        return snapped
+
     def get_vertex_index(self, vertex, threshold = 0.01) -> int | None:
-        for i, v in self.vertices.pairs():
-            if (v - vertex).dot(v - vertex) < threshold * threshold:
-                return i
-        return None
-    
+        indices = self.vertex_indices()
+        if len(indices) == 0:
+            return None
+        distances = np.sum((self._coords[indices] - np.asarray(vertex).flatten()) ** 2, axis=1)
+        closest = np.argmin(distances)
+        return int(indices[closest]) if distances[closest] < threshold * threshold else None
+
+    def is_vertex(self, vertex_index) -> bool:
+        return 0 <= vertex_index < self._size and bool(self._alive[vertex_index])
+
+    def vertex_indices(self) -> np.ndarray:
+        return np.flatnonzero(self._alive[:self._size])
+
+    def get_vertex(self, vertex_index) -> np.ndarray:
+        return self._coords[vertex_index]
+
+    def set_vertex(self, vertex_index, vertex) -> None:
+        self._detach()
+        self._coords[vertex_index] = np.asarray(vertex).flatten()
+
+    @property
+    def positions(self) -> np.ndarray:
+        """Coordinates by vertex index, rows of removed vertices are leftovers (see vertex_indices)"""
+        return self._coords[:self._size]
+
     def add_vertex(self, vertex) -> int:
-        vertex = np.asarray(vertex).flatten()
-        self.max_index += 1
-        self.vertices[self.max_index] = vertex
-        self.edges[self.max_index] = set()
-        return self.max_index
+        self._detach()
+        self._reserve(1)
+        index = self._size
+        self._size += 1
+        self._coords[index] = np.asarray(vertex).flatten()
+        self._alive[index] = True
+        return index
+
+    def add_vertices(self, vertices) -> np.ndarray:
+        """Add many vertices at once, returns their indices"""
+        self._detach()
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self._reserve(len(vertices))
+        indices = np.arange(self._size, self._size + len(vertices))
+        self._coords[indices] = vertices
+        self._alive[indices] = True
+        self._size += len(vertices)
+        return indices
+
+    def _add_half_edge(self, from_index, to_index) -> None:
+        degree = self._degree[from_index]
+        if to_index in self._adjacency[from_index, :degree]:
+            return
+        if degree == self._adjacency.shape[1]:
+            self._widen()
+        self._adjacency[from_index, degree] = to_index
+        self._degree[from_index] += 1
 
     def add_edge(self, from_index, to_index) -> None:
-        self.edges.setdefault(from_index, set()).add(to_index)
-        self.edges.setdefault(to_index, set()).add(from_index)
-    
+        self._detach()
+        self._add_half_edge(from_index, to_index)
+        self._add_half_edge(to_index, from_index)
+
+    def add_edges(self, pairs) -> None:
+        for from_index, to_index in np.asarray(pairs, dtype=np.int64).reshape(-1, 2).tolist():
+            self.add_edge(from_index, to_index)
+
+    def _remove_half_edge(self, from_index, to_index) -> None:
+        degree = self._degree[from_index]
+        row = self._adjacency[from_index]
+        slots = np.flatnonzero(row[:degree] == to_index)
+        if len(slots) == 0:
+            return
+        # Move the last neighbour into the freed slot
+        row[slots[0]] = row[degree - 1]
+        row[degree - 1] = -1
+        self._degree[from_index] -= 1
+
+    def remove_edge(self, from_index, to_index) -> None:
+        self._detach()
+        self._remove_half_edge(from_index, to_index)
+        self._remove_half_edge(to_index, from_index)
+
+    def remove_edges(self, pairs) -> None:
+        for from_index, to_index in np.asarray(pairs, dtype=np.int64).reshape(-1, 2).tolist():
+            self.remove_edge(from_index, to_index)
+
     def swap_vertices(self, v1, v2) -> None:
+        self._detach()
         # Swap coord values
-        self.vertices[v1], self.vertices[v2] = self.vertices[v2], self.vertices[v1]
+        self._coords[[v1, v2]] = self._coords[[v2, v1]]
         # Swap inwards edges (edges of neighbors to v1, and v2)
-        for neighbor in self.get_neighbors(v1):
-            if v2 in self.get_neighbors(neighbor):
+        for neighbor in self.neighbors(v1).tolist():
+            if v2 in self.neighbors(neighbor):
                 continue
-            self.edges[neighbor].remove(v1)
-            self.edges[neighbor].add(v2)
-        for neighbor in self.get_neighbors(v2):
-            if v1 in self.get_neighbors(neighbor):
+            self._remove_half_edge(neighbor, v1)
+            self._add_half_edge(neighbor, v2)
+        for neighbor in self.neighbors(v2).tolist():
+            if v1 in self.neighbors(neighbor):
                 continue
-            self.edges[neighbor].remove(v2)
-            self.edges[neighbor].add(v1)
+            self._remove_half_edge(neighbor, v2)
+            self._add_half_edge(neighbor, v1)
         # Swap outwards edges of v1 and v2
-        self.edges[v1], self.edges[v2] = self.edges[v2], self.edges[v1]
+        self._adjacency[[v1, v2]] = self._adjacency[[v2, v1]]
+        self._degree[[v1, v2]] = self._degree[[v2, v1]]
 
     def remove_vertex(self, vertex_index) -> None:
+        self._detach()
         # Remove edges pointing to vertex
-        for neighbor in self.get_neighbors(vertex_index):
-            self.edges[neighbor].remove(vertex_index)
+        for neighbor in self.neighbors(vertex_index).tolist():
+            self._remove_half_edge(neighbor, vertex_index)
 
-        # Pop new last element
-        del self.edges[vertex_index]
-        del self.vertices[vertex_index]
+        self._adjacency[vertex_index] = -1
+        self._degree[vertex_index] = 0
+        self._alive[vertex_index] = False
 
     def remove_vertices(self, delete_indices : list) -> None:
         for index in delete_indices:
             self.remove_vertex(index)
 
+    def compact(self) -> np.ndarray:
+        """Drop the rows of removed vertices, keeping the order of the rest. Returns the new index of every old one (-1 if removed)"""
+        self._detach()
+        alive = self._alive[:self._size]
+        remap = np.full(self._size + 1, -1, dtype=np.int32)
+        remap[:self._size][alive] = np.arange(np.count_nonzero(alive))
+        # -1 (empty slots) maps to remap[-1], which stays -1
+        self._adjacency = remap[self._adjacency[:self._size][alive]]
+        self._coords = self._coords[:self._size][alive]
+        self._degree = self._degree[:self._size][alive]
+        self._size = len(self._coords)
+        self._alive = np.ones(self._size, dtype=bool)
+        return remap[:-1]
+
+    def neighbors(self, vertex_index) -> np.ndarray:
+        """Neighbour indices as a view into the adjacency array"""
+        return self._adjacency[vertex_index, :self._degree[vertex_index]]
+
     def get_neighbors(self, vertex_index) -> set:
-        return self.edges.get(vertex_index, set())
-    
+        if not self.is_vertex(vertex_index):
+            return set()
+        return set(self.neighbors(vertex_index).tolist())
+
+    def degree(self, vertex_index) -> int:
+        return int(self._degree[vertex_index])
+
+    @property
+    def degrees(self) -> np.ndarray:
+        return self._degree[:self._size]
+
     def is_neighbor(self, vertex_index, neighbor_index) -> bool:
-        return neighbor_index in self.get_neighbors(vertex_index)
-    
+        return self.is_vertex(vertex_index) and neighbor_index in self.neighbors(vertex_index)
+
+    def edge_array(self) -> np.ndarray:
+        """(E,2) array of every edge once, as (smaller index, larger index)"""
+        rows, slots = np.nonzero(self._adjacency[:self._size] >= 0)
+        cols = self._adjacency[rows, slots]
+        keep = rows < cols
+        return np.stack([rows[keep], cols[keep]], axis=1)
+
     def draw_graph(self, image, edge_color = (0,255,0), vertex_color = (0,255,0), edge_width = 2, vertex_size=5, vertex_numbers = False) -> np.ndarray:
-        for i, vertex in self.vertices.items():
-            for neighbor in self.get_neighbors(i):
-                neighbor_vertex = self.vertices[neighbor]
-                cv.line(image, np.array(vertex,dtype=np.int32), np.array(neighbor_vertex,dtype=np.int32), edge_color, edge_width)
-            cv.circle(image, np.array(vertex,dtype=np.int32), vertex_size, vertex_color, -1)
+        points = self.positions.astype(np.int32)
+        for a, b in self.edge_array():
+            cv.line(image, points[a], points[b], edge_color, edge_width)
+        for i in self.vertex_indices():
+            cv.circle(image, points[i], vertex_size, vertex_color, -1)
             if vertex_numbers:
-                cv.putText(image, str(i), tuple(vertex.astype(int) + np.array([0,15])), cv.FONT_HERSHEY_SIMPLEX, 0.2, (255, 255, 0), 1, cv.LINE_AA)
+                cv.putText(image, str(i), tuple(points[i] + np.array([0,15])), cv.FONT_HERSHEY_SIMPLEX, 0.2, (255, 255, 0), 1, cv.LINE_AA)
         return image
-    
+
     def __str__(self) -> str:
-        return f"Vertices: {[ str(str(i) + str((round(v[0],2), round(v[1],2)))) if v is not None else None for i, v in self.vertices.items()]}, Edges: {self.edges}"
-    
+        return f"Vertices: {[str(i) + str((round(self._coords[i][0],2), round(self._coords[i][1],2))) for i in self.vertex_indices()]}, Edges: { {i: self.get_neighbors(i) for i in self.vertex_indices()} }"
+
     def copy(self) -> 'Graph':
-        g = Graph()
-        g.max_index = self.max_index
-        for i, vertex in self.vertices.items():
-            g.vertices[i] = vertex.copy()
-        for i, edges in self.edges.items():
-            g.edges[i] = edges.copy()
+        g = Graph.__new__(Graph)
+        g._coords, g._adjacency, g._degree, g._alive = self._coords, self._adjacency, self._degree, self._alive
+        g._size = self._size
+        g._shared = self._shared = True
         return g
-    
+
+    @property
+    def vertex_count(self) -> int:
+        return int(np.count_nonzero(self._alive[:self._size]))
+
+    @property
+    def edge_count(self) -> int:
+        return int(self.degrees.sum()) // 2
+
     @property
     def info(self) -> str:
-        return f"Vertices: {len(self.vertices)}, Edges: {sum([len(edges) for edges in self.edges.values()])}"
-    
+        return f"Vertices: {len(self.vertex_indices())}, Edges: {int(self.degrees.sum())}"
+
     def print_matrix(self) -> None:
+        indices = self.vertex_indices()
         print("X ", end="")
-        for i in self.vertices.keys():
+        for i in indices:
             if i % 10 == 0:
                 print(i, end = " ")
             else:
                 print(i%10, end = " ")
         print("")
-        for i in self.vertices.keys():
+        for i in indices:
             print(i, end=" ")
-            for j in self.vertices.keys():
-                print("1" if i in self.get_neighbors(j) else ".",end=(len(str(j+1)))*" " if (j+1)%10 == 0 else " ")
+            for j in indices:
+                print("1" if self.is_neighbor(j, i) else ".",end=(len(str(j+1)))*" " if (j+1)%10 == 0 else " ")
             print("")
-            
 
-def makeGraphFromLines(lines) -> Graph:
+
+def makeGraphFromLines(lines, combine = True) -> Graph:
     lines = lineMatrixToPairs(lines)
-    lines = combineParallelLines(lines)
-    g = Graph()
-    for i in range(0, len(lines)):
-        p1 = g.add_vertex(lines[i][0])
-        p2 = g.add_vertex(lines[i][1])
-        g.add_edge(p1, p2)
+    if combine:
+        lines = combineParallelLines(lines)
+    g = Graph(capacity=max(2 * len(lines), 16))
+    indices = g.add_vertices(np.reshape(lines, (-1, 2)))
+    g.add_edges(indices.reshape(-1, 2))
     return g
 
-def mergeOverlappingVertices(const_graph : Graph, threshold = 5, neighbor_limit = None, merge_neighbors = False) -> Graph:
-    graph = const_graph.copy()
-    keys_to_remove = []
+def mergeOverlappingVertices(const_graph : Graph, threshold = 5, neighbor_limit = None, merge_neighbors = False, inplace = False) -> Graph:
+    """
+    Take a disconnected graph and combine vertices that are close together.
+    In index order, every vertex is merged with its nearest vertex if that is closer than threshold and allowed to merge
+    (not connected unless merge_neighbors, and one of the two has at most neighbor_limit neighbors).
+    The kept vertex moves to the average of the two weighted by their number of neighbors, and later vertices see the merged graph.
+    Candidates come from a grid of threshold-sized cells that follows the merges, instead of sorting every vertex.
+    inplace: change const_graph itself instead of a copy.
+    """
+    graph = const_graph if inplace else const_graph.copy()
+    cells = {}
+    def cellOf(point):
+        return (int(np.floor(point[0] / threshold)), int(np.floor(point[1] / threshold)))
+    for i in graph.vertex_indices().tolist():
+        cells.setdefault(cellOf(graph.get_vertex(i)), set()).add(i)
 
-    """Take a disconnected graph and combine vertices that are close together"""
-    for i, vertex in graph.vertices.items():
-        if vertex is None:
+    for i in graph.vertex_indices().tolist():
+        if not graph.is_vertex(i):
             continue
-        for j, vertex2 in sorted(graph.vertices.items(),key=lambda x: np.linalg.norm(vertex - x[1]) if x[1] is not None else 10000):
-            # if(j <= i):
-            #     continue
-    
-                    
-            if vertex2 is None:
-                continue
+        vertex = graph.get_vertex(i).copy()
+        x, y = cellOf(vertex)
+        # Everything closer than threshold is in the 3x3 cells around the vertex, in index order for ties
+        near = np.array(sorted(j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in cells.get((x + dx, y + dy), ())), dtype=np.int64)
+        for j in near[np.argsort(np.linalg.norm(graph.positions[near] - vertex, axis=1), kind="stable")].tolist():
             # Skip if the same vertex
             if i == j:
                 continue
             # Skip if the vertices are connected
-            if not merge_neighbors and (j in graph.get_neighbors(i) or i in graph.get_neighbors(j)):
+            if not merge_neighbors and graph.is_neighbor(i, j):
                 continue
-            if neighbor_limit is not None and not (len(graph.get_neighbors(j)) <= neighbor_limit or len(graph.get_neighbors(i)) <= neighbor_limit):
+            if neighbor_limit is not None and not (graph.degree(j) <= neighbor_limit or graph.degree(i) <= neighbor_limit):
                 continue
 
+            vertex2 = graph.get_vertex(j).copy()
             if np.linalg.norm(vertex - vertex2) < threshold:
-                for neighbor in graph.get_neighbors(j):
-                    if neighbor == j or neighbor == i:
-                        continue
-
-                    graph.add_edge(i, neighbor)
-                    graph.edges[neighbor].remove(j)
-
-                # Merge the positions
-                weight_i = len(graph.get_neighbors(i))
-                weight_j = len(graph.get_neighbors(j))
-                if(weight_i == 0 and weight_j == 0):
-                    weight_i = 1
-                    weight_j = 1
-                graph.vertices[i] = (weight_i*vertex + weight_j*vertex2) / (weight_j + weight_i)
-                # Remove j
-                if j in graph.edges[i]:
-                    graph.edges[i].remove(j)
-                graph.vertices[j] = None
-                graph.edges[j] = set()
-                keys_to_remove.append(j)
-            # List is sorted so if one doesn't fit threshhold none do, or a neighbor was found.
+                # j is weighted by its neighbours before they move over to i
+                weight_j = graph.degree(j)
+                for neighbor in graph.neighbors(j).tolist():
+                    if neighbor != i:
+                        graph.add_edge(i, neighbor)
+
+                # Merge the positions, i still counts j as a neighbour if they were connected
+                weight_i = graph.degree(i)
+                if weight_i == 0 and weight_j == 0:
+                    weight_i = weight_j = 1
+                graph.remove_vertex(j)
+                cells[cellOf(vertex2)].discard(j)
+                cells[cellOf(vertex)].discard(i)
+                graph.set_vertex(i, (weight_i*vertex + weight_j*vertex2) / (weight_j + weight_i))
+                cells.setdefault(cellOf(graph.get_vertex(i)), set()).add(i)
+            # Candidates are sorted so if one doesn't fit threshold none do, or a neighbor was found.
             break
-    graph.remove_vertices(keys_to_remove)
     return graph
 
-def _sliceEdges(graph : Graph,tree, a,b,c,d, threshold_detect = 5, threshold_splice = 5):
-    p1, t, u, ab_len, cd_len = _segmentIntersection(graph.vertices[a], graph.vertices[b], graph.vertices[c], graph.vertices[d], threshold=threshold_detect)
-    if p1 is None:
-        # No intersection
-        return False
-    p1_index = c if u < 0.5 else d
-    in_ab = t > 0 + threshold_splice/ab_len and t < 1 - threshold_splice/ab_len
-    in_cd = u > 0 + threshold_splice/cd_len and u < 1 - threshold_splice/cd_len
-
-    if in_ab:
-        p1_index = graph.add_vertex(p1)
-        graph.edges[a].remove(b)
-        graph.edges[b].remove(a)
-        graph.add_edge(p1_index, a)
-        graph.add_edge(p1_index, b)
-        
-
-        tree[(a, b)] = (a, p1_index, b)
-    else:
-        pass
-    if in_cd:
-        p2_index = graph.add_vertex(p1)
-        graph.edges[c].remove(d)
-        graph.edges[d].remove(c)
-        graph.add_edge(c, p2_index)
-        graph.add_edge(p2_index, c)
-        graph.add_edge(d, p2_index)
-        graph.add_edge(p2_index, d)
-
-        tree[(c, d)] = (c, p2_index, d)
-    else:
-        pass
-    return in_ab or in_cd
-
-def connectIntersectingEdges(const_graph : Graph, threshold_detect = 5, threshold_splice = 0):
+def connectIntersectingEdges(const_graph : Graph, threshold_detect = 5, threshold_splice = 0, inplace = False):
     """
-    threshold_extend: The threshold for how many pixels edges can be extended by.
-    threshold_combine: how close in pixels does the intersection have to be to an end to combine them.
+    Split every pair of crossing edges at their crossing, in one pass over the crossings found through a SegmentGrid.
+    threshold_detect: The threshold for how many pixels edges can be extended by.
+    threshold_splice: how close in pixels does the intersection have to be to an end to not split there.
+    If only one of the two edges is split, it is split at the closer end of the other edge so the two connect.
+    inplace: change const_graph itself instead of a copy.
     """
-    graph = const_graph.copy()
-    replaced_edges = dict()
-    # Go over all edges for intersections.
-    # All edges means all starting points 'a' and 'c', and all end points 'b' and 'd' where a < b and c < d
-    for a, v_a in const_graph.vertices.items():
-        for c, v_c in const_graph.vertices.items():
-            if c <= a:
-                continue
-            for b in const_graph.get_neighbors(a):
-                for d in const_graph.get_neighbors(c):
-                    # if a == d or b == c it's the same edge. if b <= a or d <= c the reverse edge was already found
-                    if a == d or b == c or b <= a or d <= c:
-                        continue
-                    ab_candidates = [(a, b)]
-                    cd_candidates = [(c, d)]
-                    while any([edge in replaced_edges.keys() for edge in ab_candidates + cd_candidates]):
-                        # Replace edges with their replacements (iteratively)
-                        # This is done in three stages to maintain edges which don't have replacements?
-                        # In more detail, (a,b) -> (a, p1, b) or stays as (a, b)
-                        ab_candidates = [replaced_edges.get(edge, edge) for edge in ab_candidates]
-                        cd_candidates = [replaced_edges.get(edge, edge) for edge in cd_candidates]
-                        # (a, p1, b) -> [(a, p1)] + [(p1, b)]   but (c,d) -> [(c, d)] + [None]
-                        ab_candidates = [(edge[0], edge[1]) if len(edge) == 3 else edge for edge in ab_candidates] + [(edge[1], edge[2]) if len(edge) == 3 else None for edge in ab_candidates]
-                        cd_candidates = [(edge[0], edge[1]) if len(edge) == 3 else edge for edge in cd_candidates] + [(edge[1], edge[2]) if len(edge) == 3 else None for edge in cd_candidates]
-                        # [(a, p1), (p1, b), (c, d), None] -> [(a, p1), (p1, b), (c, d)]
-                        ab_candidates = [edge for edge in ab_candidates if edge is not None]
-                        cd_candidates = [edge for edge in cd_candidates if edge is not None]
-                    
-                    for ab, cd in itertools.product(ab_candidates, cd_candidates):
-                        # Do all combinations until one is found
-                        if _sliceEdges(graph, replaced_edges, *ab, *cd, threshold_detect=threshold_detect, threshold_splice=threshold_splice):
-                            break
-
-
-                    
+    graph = const_graph if inplace else const_graph.copy()
+    edges = graph.edge_array()
+    segments = graph.positions[edges]
+    pairs = SegmentGrid(segments, cell_size=max(2 * threshold_detect, 8)).crossing_pairs(threshold_detect)
+    # Edges sharing a vertex already meet
+    ab, cd = edges[pairs[:, 0]], edges[pairs[:, 1]]
+    pairs = pairs[(ab[:, 0] != cd[:, 0]) & (ab[:, 0] != cd[:, 1]) & (ab[:, 1] != cd[:, 0]) & (ab[:, 1] != cd[:, 1])]
+    if len(pairs) == 0:
+        return graph
+
+    ab, cd = pairs[:, 0], pairs[:, 1]
+    t, u = segmentParams(segments[ab], segments[cd])
+    lengths = np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1)
+    in_ab = (t > threshold_splice / lengths[ab]) & (t < 1 - threshold_splice / lengths[ab])
+    in_cd = (u > threshold_splice / lengths[cd]) & (u < 1 - threshold_splice / lengths[cd])
+
+    # Where both edges are split they share one new vertex at the intersection
+    both = in_ab & in_cd
+    new_vertices = graph.add_vertices(segments[ab[both], 0] + t[both, None] * (segments[ab[both], 1] - segments[ab[both], 0]))
+    ab_vertex = np.where(u < 0.5, edges[cd, 0], edges[cd, 1])
+    cd_vertex = np.where(t < 0.5, edges[ab, 0], edges[ab, 1])
+    ab_vertex[both] = new_vertices
+    cd_vertex[both] = new_vertices
+
+    # (edge, fraction along it, vertex) of every split, ordered along each edge
+    split_edges = np.concatenate([ab[in_ab], cd[in_cd]])
+    if len(split_edges) == 0:
+        # Every crossing is within threshold_splice of an end of both edges
+        return graph
+    split_t = np.concatenate([t[in_ab], u[in_cd]])
+    split_vertices = np.concatenate([ab_vertex[in_ab], cd_vertex[in_cd]])
+    order = np.lexsort((split_t, split_edges))
+    split_edges, split_vertices = split_edges[order], split_vertices[order]
+    keep = np.ones(len(split_edges), dtype=bool)
+    keep[1:] = (split_edges[1:] != split_edges[:-1]) | (split_vertices[1:] != split_vertices[:-1])
+    split_edges, split_vertices = split_edges[keep], split_vertices[keep]
+
+    # Replace every split edge a-b with the chain a-v1-v2-...-b
+    first = np.ones(len(split_edges), dtype=bool)
+    first[1:] = split_edges[1:] != split_edges[:-1]
+    last = np.roll(first, -1)
+    previous = np.where(first, edges[split_edges, 0], np.roll(split_vertices, 1))
+    graph.remove_edges(edges[np.unique(split_edges)])
+    graph.add_edges(np.concatenate([np.stack([previous, split_vertices], axis=1),
+                                    np.stack([split_vertices[last], edges[split_edges[last], 1]], axis=1)]))
     return graph
 
 
-def _getFaces(graph : Graph, v_start, visited_vertices : set, face : list):
-    if len(face) == 4 and v_start in graph.get_neighbors(face[-1]):
-        return [face]
-    if len(face) >= 4:
+class PlanarGraphBuilder:
+    """
+    Builds the planar graph of detected lines in stages that all work on the same graph, without copies.
+    Stages can be switched off by name, e.g. PlanarGraphBuilder(merge_far=False),
+    and after build() stats holds (stage, vertices, edges, seconds) for every stage that ran.
+    """
+    # (name, function, arguments) of the stages after the graph is made from the lines
+    GRAPH_STAGES = (
+        ("merge_ends", mergeOverlappingVertices, dict(threshold=9, neighbor_limit=1)),
+        ("intersect", connectIntersectingEdges, dict(threshold_splice=0, threshold_detect=7)),
+        ("merge_close", mergeOverlappingVertices, dict(threshold=5, merge_neighbors=True)),
+        ("merge_far", mergeOverlappingVertices, dict(threshold=8, merge_neighbors=True)),
+    )
+    STAGES = ("combine",) + tuple(name for name, _, _ in GRAPH_STAGES)
+
+    def __init__(self, **enabled):
+        unknown = set(enabled) - set(self.STAGES)
+        if unknown:
+            raise ValueError(f"Unknown graph stages {sorted(unknown)}, the stages are {self.STAGES}")
+        self.enabled = {stage: enabled.get(stage, True) for stage in self.STAGES}
+        self.stats = []
+
+    def build(self, lines) -> Graph:
+        self.stats = []
+        lines = lineMatrixToPairs(lines)
+        start = time.perf_counter()
+        if self.enabled["combine"]:
+            lines = combineParallelLines(lines)
+        graph = makeGraphFromLines(lines, combine=False)
+        self._record("combine" if self.enabled["combine"] else "graph", graph, start)
+
+        for name, stage, arguments in self.GRAPH_STAGES:
+            if not self.enabled[name]:
+                continue
+            start = time.perf_counter()
+            stage(graph, inplace=True, **arguments)
+            self._record(name, graph, start)
+        graph.compact()
+        return graph
+
+    def _record(self, name, graph : Graph, start) -> None:
+        self.stats.append((name, graph.vertex_count, graph.edge_count, time.perf_counter() - start))
+
+    def report(self) -> str:
+        return "\n".join(f"{name:<12} vertices: {vertices:<5} edges: {edges:<5} {1000 * seconds:.2f}ms" for name, vertices, edges, seconds in self.stats)
+
+def _cycleEdges(graph : Graph) -> np.ndarray:
+    """Edges of the graph without the dangling chains, which can't be part of a face"""
+    edges = graph.edge_array()
+    while len(edges):
+        degrees = np.bincount(edges.ravel(), minlength=len(graph.positions))
+        keep = (degrees[edges[:, 0]] > 1) & (degrees[edges[:, 1]] > 1)
+        if keep.all():
+            break
+        edges = edges[keep]
+    return edges
+
+def _faceCycles(graph : Graph) -> list:
+    """
+    Vertex cycles around every face of the (planar) graph.
+    Each vertex's outgoing half edges are sorted by angle, and a face is walked by leaving every vertex
+    along the half edge right after the one it was entered by. Every half edge belongs to exactly one face.
+    """
+    edges = _cycleEdges(graph)
+    count = len(edges)
+    if count == 0:
         return []
-    faces = []
-    for neighbor in graph.get_neighbors(face[-1]):
-        if neighbor in visited_vertices:
-            continue
-        next_visited = visited_vertices.copy()
-        next_visited.add(neighbor)
-        faces += _getFaces(graph, v_start, next_visited, face + [neighbor])
-        if len(face) >= 2:
-            prev_edge = np.array(graph.vertices[face[-1]]) - graph.vertices[face[-2]]
-            curr_edge = np.array(graph.vertices[neighbor]) - graph.vertices[face[-1]]
-            if np.dot(prev_edge, curr_edge) / (np.linalg.norm(prev_edge) * np.linalg.norm(curr_edge)) > 0.95:
-                faces += _getFaces(graph, v_start, next_visited, face[:-1] + [neighbor])
+    half_edges = np.concatenate([edges, edges[:, ::-1]])
+    twins = np.concatenate([np.arange(count, 2 * count), np.arange(count)])
+    vectors = graph.positions[half_edges[:, 1]] - graph.positions[half_edges[:, 0]]
+    order = np.lexsort((np.arctan2(vectors[:, 1], vectors[:, 0]), half_edges[:, 0]))
+    rank = np.empty(2 * count, dtype=np.int64)
+    rank[order] = np.arange(2 * count)
+    origins = half_edges[order, 0]
+    starts = np.searchsorted(origins, half_edges[:, 0], 'left')
+    degrees = np.searchsorted(origins, half_edges[:, 0], 'right') - starts
 
+    # The half edge after (u -> v) leaves v next to (v -> u)
+    twin_rank = rank[twins]
+    next_half_edge = order[starts[twins] + (twin_rank - starts[twins] + 1) % degrees[twins]]
 
-    return faces
+    cycles = []
+    visited = np.zeros(2 * count, dtype=bool)
+    for half_edge in range(2 * count):
+        cycle = []
+        while not visited[half_edge]:
+            visited[half_edge] = True
+            cycle.append(half_edges[half_edge, 0])
+            half_edge = next_half_edge[half_edge]
+        if cycle:
+            cycles.append(cycle)
+    return cycles
 
-def getFaces(graph : Graph):
-    """Return the faces of the graph"""
-    faces_list = [] # Preserve vertex order
-    faces_set = set() # Prevent repetitions ( there are 7 per face )
-    for i in graph.vertices.keys():
-        faces_list += _getFaces(graph, i, set([i]), [i])
-    
-    unique_face_list = []
-    for face in faces_list:
-        if frozenset(face) not in faces_set:
-            unique_face_list.append([graph.vertices[v] for v in face])
-            faces_set.add(frozenset(face))
-    return unique_face_list
+def getFaces(graph : Graph, collinear_cos = 0.95):
+    """
+    Return the quadrilateral faces of the graph.
+    Every bounded 4-cycle is a face. On longer cycles, vertices where the boundary continues straight on
+    (cosine above collinear_cos) don't count as corners.
+    Only faces are returned, so a 4-cycle with an edge through its inside (two faces sharing that edge,
+    like a quad split by a diagonal) isn't one, although the old search over all 4-cycles found those too.
+    """
+    faces = []
+    for cycle in _faceCycles(graph):
+        points = graph.positions[cycle]
+        # Walking the faces this way goes around bounded faces with negative (shoelace) area, outer faces are positive
+        area = np.sum(points[:, 0] * np.roll(points[:, 1], -1) - np.roll(points[:, 0], -1) * points[:, 1])
+        if area >= 0 or len(cycle) < 4:
+            continue
+        if len(cycle) == 4:
+            faces.append(list(points))
+            continue
+        incoming = points - np.roll(points, 1, axis=0)
+        outgoing = np.roll(points, -1, axis=0) - points
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos = np.sum(incoming * outgoing, axis=1) / (np.linalg.norm(incoming, axis=1) * np.linalg.norm(outgoing, axis=1))
+        corners = ~(cos > collinear_cos)
+        if np.count_nonzero(corners) == 4:
+            faces.append(list(points[corners]))
+    return faces
 
 if __name__ == "__main__":
     g = Graph()
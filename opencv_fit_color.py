@@ -14,38 +14,340 @@ def toRange(v, min, max, newmin, newmax):
 def loss_function(point, rho, phi):
     return pow(point[1]*np.sin((phi)) + point[0]*np.cos((phi)) - rho,2)
 
+def line_losses(points, lines):
+    """
+    loss_function of every point against every line.
+    (...,P,2) points and (L,2) lines of [rho, phi] give (...,P,L) losses, with inf where a point is at infinity.
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    points = np.asarray(points, dtype=np.float64)
+    with np.errstate(invalid='ignore', over='ignore'):
+        losses = (points[..., 1:2] * np.sin(lines[:, 1]) + points[..., 0:1] * np.cos(lines[:, 1]) - lines[:, 0]) ** 2
+    return np.nan_to_num(losses, nan=np.inf)
+
 def min_loss(points, lines):
     """
     Assumes lines are list of [rho, phi] where rho is offset and phi is radian angle
     Assumes that the points are actually inverted? like (y, x) instead of (x, y)
     opencv is stupid
     """
-    return sum([min([loss_function(point, rho, phi) for point in points]) for rho, phi in lines]) / len(lines)
-    
+    return line_losses(points, lines).min(axis=0).mean()
+
+def batch_loss(angles, lines, block_size = 256):
+    """
+    sum_loss of a (K,2) array of (phi, theta) candidates against (L,2) lines, as a (K,) array.
+    The candidates go through in blocks, so memory is block_size * 3 * L per block.
+    """
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 2)
+    losses = np.empty(len(angles))
+    for start in range(0, len(angles), block_size):
+        points = get_focal_points_batch(angles[start:start + block_size])
+        losses[start:start + block_size] = line_losses(points, lines).min(axis=1).mean(axis=1)
+    return losses
+
 def sum_loss(phi, theta, lines):
     return min_loss(get_focal_points(phi, theta), lines)
 
-def regress_lines(lines, iterations = 500, refinement_iterations = 100, refinement_area=0.3):
-
+def regress_lines(lines, iterations = 500, refinement_iterations = 100, refinement_area=0.3, seed = None):
+    """
+    Random search for the camera angles. seed makes it repeatable, otherwise numpy's global random state is used.
+    """
+    random = np.random if seed is None else np.random.RandomState(seed)
     best_loss = 100000
     best_phi_theta = (0, 0)
-    for i in range(0,iterations):
-        phi = np.random.rand()*np.pi
-        theta = np.random.rand()*np.pi/2
-        if sum_loss(phi, theta, lines) < best_loss:
-            best_loss = sum_loss(phi, theta, lines)
-            best_phi_theta = (phi, theta)
+    candidates = random.rand(iterations, 2) * [np.pi, np.pi/2]
+    losses = batch_loss(candidates, lines)
+    if len(losses) and losses.min() < best_loss:
+        best_loss = losses.min()
+        best_phi_theta = tuple(candidates[np.argmin(losses)])
 
     current_phi, current_theta = best_phi_theta
-    for i in range(0,refinement_iterations):
-        phi = np.random.rand()*refinement_area + current_phi - refinement_area/2
-        theta = np.random.rand()*refinement_area + current_theta - refinement_area/2
-        if sum_loss(phi, theta, lines) < best_loss:
-            best_loss = sum_loss(phi, theta, lines)
-            best_phi_theta = (phi, theta)
+    candidates = random.rand(refinement_iterations, 2) * refinement_area + [current_phi - refinement_area/2, current_theta - refinement_area/2]
+    losses = batch_loss(candidates, lines)
+    if len(losses) and losses.min() < best_loss:
+        best_loss = losses.min()
+        best_phi_theta = tuple(candidates[np.argmin(losses)])
     print(" The loss is ", best_loss)
     return best_phi_theta, best_loss
 
+def _nelder_mead(loss, start, step, tolerance = 1e-4, max_iterations = 100):
+    """
+    Minimize loss (a function of a (K,2) batch) from start with a Nelder-Mead simplex of size step.
+    Stops once the simplex is smaller than tolerance radians and its losses agree to a relative tolerance.
+    Returns the best point, its loss and how many points were evaluated.
+    """
+    simplex = np.array([start, start + [step, 0], start + [0, step]], dtype=np.float64)
+    values = loss(simplex)
+    evaluations = 3
+    for _ in range(max_iterations):
+        order = np.argsort(values)
+        simplex, values = simplex[order], values[order]
+        if np.max(np.abs(simplex[1:] - simplex[0])) < tolerance and values[-1] - values[0] <= tolerance * (1 + abs(values[0])):
+            break
+        centroid = simplex[:2].mean(axis=0)
+        # Reflect the worst point, then expand or contract
+        reflected = centroid + (centroid - simplex[2])
+        reflected_value = loss(reflected[None])[0]
+        evaluations += 1
+        if reflected_value < values[0]:
+            expanded = centroid + 2 * (centroid - simplex[2])
+            expanded_value = loss(expanded[None])[0]
+            evaluations += 1
+            simplex[2], values[2] = (expanded, expanded_value) if expanded_value < reflected_value else (reflected, reflected_value)
+        elif reflected_value < values[1]:
+            simplex[2], values[2] = reflected, reflected_value
+        else:
+            contracted = centroid + 0.5 * (simplex[2] - centroid)
+            contracted_value = loss(contracted[None])[0]
+            evaluations += 1
+            if contracted_value < values[2]:
+                simplex[2], values[2] = contracted, contracted_value
+            else:
+                # Shrink towards the best point
+                simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+                values[1:] = loss(simplex[1:])
+                evaluations += 2
+    best = np.argmin(values)
+    return simplex[best], values[best], evaluations
+
+def coarse_to_fine(lines, grid = (36, 18), starts = 3, tolerance = 1e-4, max_iterations = 100, seed = None):
+    """
+    Deterministic search for the camera angles: the loss over a coarse (phi, theta) grid,
+    then Nelder-Mead from the best few grid points.
+    seed shifts the grid by a random fraction of a cell, without it the grid is fixed.
+    Returns ((phi, theta), loss) like regress_lines.
+    """
+    shift = np.full(2, 0.5) if seed is None else np.random.RandomState(seed).rand(2)
+    phis = (np.arange(grid[0]) + shift[0]) * np.pi / grid[0]
+    thetas = (np.arange(grid[1]) + shift[1]) * np.pi/2 / grid[1]
+    candidates = np.stack(np.meshgrid(phis, thetas, indexing='ij'), axis=-1).reshape(-1, 2)
+    losses = batch_loss(candidates, lines)
+
+    best_phi_theta, best_loss = candidates[np.argmin(losses)], losses.min()
+    step = np.pi / grid[0] / 2
+    for start in candidates[np.argsort(losses)[:starts]]:
+        phi_theta, loss, _ = _nelder_mead(lambda angles: batch_loss(angles, lines), start, step, tolerance, max_iterations)
+        if loss < best_loss:
+            best_phi_theta, best_loss = phi_theta, loss
+    return tuple(best_phi_theta), best_loss
+
+def vanishing_directions(angles):
+    """
+    Unit directions in camera space of the three vanishing points of a (K,2) array of (phi, theta), as (K,3,3).
+    They project through getIntrinsicsMatrix onto get_focal_points and are mutually orthogonal.
+    """
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 2)
+    phi, theta = angles[:, 0], angles[:, 1]
+    tan_theta, zeros = np.tan(theta), np.zeros_like(phi)
+    directions = np.stack([np.stack([np.ones_like(phi), tan_theta * np.cos(phi), tan_theta * np.sin(phi)], axis=-1),
+                           np.stack([zeros, -np.sin(phi), np.cos(phi)], axis=-1),
+                           np.stack([-tan_theta, np.cos(phi), np.sin(phi)], axis=-1)], axis=1)
+    return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+def line_normals(lines):
+    """Unit normals of the great circles that (L,2) lines of [rho, phi] make on the Gaussian sphere, as (L,3)"""
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    camera_matrix = getIntrinsicsMatrix()
+    normals = np.stack([np.cos(lines[:, 1]), np.sin(lines[:, 1]), -lines[:, 0]], axis=-1) @ camera_matrix
+    return normals / np.linalg.norm(normals, axis=-1, keepdims=True)
+
+def _sphere_bins(directions, bins):
+    """Accumulator cell (azimuth, polar) of unit directions, folded onto the z >= 0 hemisphere"""
+    directions = np.where(directions[..., 2:3] < 0, -directions, directions)
+    azimuth = np.fmod(np.arctan2(directions[..., 1], directions[..., 0]) + 2*np.pi, 2*np.pi)
+    polar = np.arccos(np.clip(directions[..., 2], -1, 1))
+    return (np.minimum((azimuth / (2*np.pi) * bins[0]).astype(np.int64), bins[0] - 1),
+            np.minimum((polar / (np.pi/2) * bins[1]).astype(np.int64), bins[1] - 1))
+
+def sphere_accumulator(lines, weights = None, bins = (360, 90), blur = 1.0):
+    """
+    Votes of (L,2) lines on a (azimuth, polar) grid over the Gaussian half-sphere.
+    Every line votes once, with its weight, into each cell its great circle crosses.
+    """
+    normals = line_normals(lines)
+    weights = np.ones(len(normals)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+    # Orthonormal basis of each great circle, sampled finer than the cells
+    helper = np.where(np.abs(normals[:, 2:3]) < 0.9, [[0, 0, 1]], [[1, 0, 0]])
+    u = np.cross(normals, helper)
+    u /= np.linalg.norm(u, axis=-1, keepdims=True)
+    v = np.cross(normals, u)
+    t = np.linspace(0, np.pi, 4 * max(bins), endpoint=False)
+    samples = np.cos(t)[None, :, None] * u[:, None] + np.sin(t)[None, :, None] * v[:, None]
+
+    azimuth, polar = _sphere_bins(samples, bins)
+    cells = np.unique((np.arange(len(normals))[:, None] * bins[0] + azimuth) * bins[1] + polar)
+    line_index, cell = np.divmod(cells, bins[0] * bins[1])
+    accumulator = np.bincount(cell, weights=weights[line_index], minlength=bins[0] * bins[1]).reshape(bins)
+
+    if blur:
+        # Azimuth wraps around, past the equator the other side of the sphere comes back half a turn away
+        pad = int(np.ceil(3 * blur))
+        padded = np.pad(accumulator, ((pad, pad), (0, 0)), mode='wrap')
+        mirrored = np.pad(np.roll(accumulator, bins[0] // 2, axis=0), ((pad, pad), (0, 0)), mode='wrap')[:, :-pad-1:-1]
+        padded = np.concatenate([padded, mirrored], axis=1)
+        padded = cv.GaussianBlur(padded, (0, 0), blur, borderType=cv.BORDER_REFLECT)
+        accumulator = padded[pad:-pad, :bins[1]]
+    return accumulator
+
+def gaussian_sphere(lines, weights = None, bins = (360, 90), blur = 1.0, resolution = np.deg2rad(0.5), seed = None):
+    """
+    Camera angles from Gaussian sphere voting: the (phi, theta) whose three orthogonal vanishing directions
+    collect the most votes in sphere_accumulator. Deterministic, seed is only accepted for the common interface.
+    Returns ((phi, theta), loss) like regress_lines.
+    """
+    accumulator = sphere_accumulator(lines, weights, bins, blur)
+    phis = np.arange(resolution / 2, np.pi, resolution)
+    thetas = np.arange(resolution / 2, np.pi/2, resolution)
+    candidates = np.stack(np.meshgrid(phis, thetas, indexing='ij'), axis=-1).reshape(-1, 2)
+    votes = accumulator[_sphere_bins(vanishing_directions(candidates), bins)].sum(axis=1)
+
+    phi_theta = candidates[np.argmax(votes)]
+    return tuple(phi_theta), batch_loss(phi_theta, lines)[0]
+
+def angles_from_direction(directions):
+    """
+    (phi, theta) hypotheses that put a vanishing point on each of (N,3) camera space directions,
+    once as the first and once as the third point of get_focal_points.
+    Returns a (2N,2) array, nan where the direction can't be that vanishing point for phi in [0, pi) and theta in [0, pi/2).
+    """
+    a, b, c = np.moveaxis(np.asarray(directions, dtype=np.float64).reshape(-1, 3), -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # First point: (1, tan(theta) cos(phi), tan(theta) sin(phi)), up to scale
+        first = np.stack([np.arctan2(c / a, b / a), np.arctan2(np.hypot(b, c), np.abs(a))], axis=-1)
+        first[~(c / a > 0)] = np.nan
+        # Third point: (-tan(theta), cos(phi), sin(phi)), up to scale
+        sign = np.where(c < 0, -1, 1)
+        third = np.stack([np.arctan2(sign * c, sign * b), np.arctan2(-sign * a, np.hypot(b, c))], axis=-1)
+        third[~(-sign * a > 0)] = np.nan
+    return np.concatenate([first, third])
+
+def line_labels(angles, lines, threshold = 700):
+    """
+    which_line for every line under (phi, theta), as integers: 0, 1, 2 for x, y, z and -1 for none.
+    A (K,2) array of angles gives (K,L) labels.
+    """
+    losses = line_losses(get_focal_points_batch(angles), lines)
+    labels = losses.argmin(axis=1)
+    labels[losses.min(axis=1) >= threshold] = -1
+    return labels
+
+def _inlier_score(angles, lines, threshold):
+    """Inlier count and summed inlier loss of (K,2) angles"""
+    losses = line_losses(get_focal_points_batch(angles), lines).min(axis=1)
+    inliers = losses < threshold
+    return inliers.sum(axis=1), np.where(inliers, losses, 0).sum(axis=1)
+
+def ransac_vanishing_points(lines, threshold = 700, confidence = 0.99, min_hypotheses = 128, max_hypotheses = 1500, batch = 32, min_angle = np.deg2rad(5), refine = True, seed = None):
+    """
+    Camera angles from line pairs: the intersection of two lines is a candidate vanishing point,
+    which back projected through getIntrinsicsMatrix fixes (phi, theta).
+    Hypotheses are scored by how many lines which_line assigns under threshold. Pairs are drawn until
+    the chance of having missed a better one is below 1 - confidence, but at least min_hypotheses of them
+    as noisy segments make only a few of the inlier pairs land close enough.
+    Returns ((phi, theta), loss, labels) with labels as in line_labels.
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    random = np.random if seed is None else np.random.RandomState(seed)
+    homogeneous = np.stack([np.cos(lines[:, 1]), np.sin(lines[:, 1]), -lines[:, 0]], axis=-1)
+    inverse_camera = np.linalg.inv(getIntrinsicsMatrix())
+
+    best_angles, best_count, best_loss = np.array([np.pi/2, np.pi/4]), 0, np.inf
+    drawn, needed = 0, max_hypotheses
+    while drawn < min(max(needed, min_hypotheses), max_hypotheses) and len(lines) > 1:
+        pairs = random.randint(0, len(lines), size=(batch, 2))
+        difference = np.abs(np.fmod(lines[pairs[:, 0], 1] - lines[pairs[:, 1], 1] + np.pi, np.pi))
+        pairs = pairs[np.minimum(difference, np.pi - difference) > min_angle]
+        drawn += batch
+        if len(pairs) == 0:
+            continue
+
+        vanishing = np.cross(homogeneous[pairs[:, 0]], homogeneous[pairs[:, 1]])
+        angles = angles_from_direction(vanishing @ inverse_camera.T)
+        angles = angles[~np.isnan(angles).any(axis=1)]
+        if len(angles) == 0:
+            continue
+
+        losses = line_losses(get_focal_points_batch(angles), lines).min(axis=1)
+        inliers = losses < threshold
+        counts = inliers.sum(axis=1)
+        inlier_losses = np.where(inliers, losses, 0).sum(axis=1)
+        best = np.lexsort((inlier_losses, -counts))[0]
+        if counts[best] > best_count or (counts[best] == best_count and inlier_losses[best] < best_loss):
+            best_angles, best_count, best_loss = angles[best], counts[best], inlier_losses[best]
+            # With the inliers spread over the three points, a pair meets at the first or third one with probability 2 (ratio / 3)^2
+            good = 2 * (best_count / len(lines) / 3) ** 2
+            needed = np.log(1 - confidence) / np.log(1 - good) if good < 1 else 0
+
+    if refine and best_count > 0:
+        inlier_lines = lines[line_labels(best_angles, lines, threshold)[0] >= 0]
+        best_angles, _, _ = _nelder_mead(lambda angles: batch_loss(angles, inlier_lines), best_angles, np.deg2rad(1))
+    return tuple(best_angles), batch_loss(best_angles, lines)[0], line_labels(best_angles, lines, threshold)[0]
+
+def ransac_angles(lines, seed = None, **arguments):
+    """ransac_vanishing_points without the labels, for ANGLE_OPTIMIZERS"""
+    phi_theta, loss, _ = ransac_vanishing_points(lines, seed=seed, **arguments)
+    return phi_theta, loss
+
+# Camera angle searches, all called as optimizer(lines, seed=seed, **arguments) and returning ((phi, theta), loss)
+ANGLE_OPTIMIZERS = {
+    "random": regress_lines,
+    "coarse_to_fine": coarse_to_fine,
+    "gaussian_sphere": gaussian_sphere,
+    "ransac": ransac_angles,
+}
+
+def estimate_camera_angles(lines, method = "coarse_to_fine", seed = None, **arguments):
+    """Camera angles (phi, theta) and their loss, with the search picked by name from ANGLE_OPTIMIZERS (or a function)"""
+    optimizer = method if callable(method) else ANGLE_OPTIMIZERS[method]
+    return optimizer(lines, seed=seed, **arguments)
+
+class VanishingPointTracker:
+    """
+    Camera angles over consecutive frames. Each frame searches a small window around the last (phi, theta)
+    and only runs the global search (method, as in estimate_camera_angles) when the loss jumps by more than jump times.
+    """
+    def __init__(self, method = "coarse_to_fine", window = np.deg2rad(4), jump = 1.5, grid = 5, tolerance = 1e-4, max_iterations = 40):
+        self.method = method
+        self.window = window
+        self.jump = jump
+        self.grid = grid
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.reset()
+
+    def reset(self):
+        self.angles = None
+        self.loss = None
+        self.frames = 0
+        self.global_searches = 0
+
+    def local_search(self, lines):
+        """Best angles inside the window around the last ones, from a small grid and Nelder-Mead"""
+        offsets = np.linspace(-self.window / 2, self.window / 2, self.grid)
+        candidates = self.angles + np.stack(np.meshgrid(offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 2)
+        losses = batch_loss(candidates, lines)
+        angles, loss, _ = _nelder_mead(lambda angles: batch_loss(angles, lines), candidates[np.argmin(losses)],
+                                       self.window / self.grid, self.tolerance, self.max_iterations)
+        return angles, loss
+
+    def update(self, lines, seed = None, **arguments):
+        """
+        Camera angles of the next frame, ((phi, theta), loss) like estimate_camera_angles.
+        arguments go to the global search.
+        """
+        self.frames += 1
+        angles, loss = None, np.inf
+        if self.angles is not None:
+            angles, loss = self.local_search(lines)
+        if angles is None or loss > self.loss * self.jump:
+            self.global_searches += 1
+            global_angles, global_loss = estimate_camera_angles(lines, self.method, seed=seed, **arguments)
+            if global_loss < loss:
+                angles, loss = np.array(global_angles), global_loss
+        self.angles, self.loss = np.asarray(angles, dtype=np.float64), loss
+        return tuple(self.angles), loss
+
 def which_line(focal_points, line, threshold = 700):
     x_loss, y_loss, z_loss = loss_function(focal_points[0], *line), loss_function(focal_points[1], *line), loss_function(focal_points[2], *line)
     if min([x_loss, y_loss, z_loss]) >= threshold:
@@ -68,7 +370,7 @@ def which_color(line_type):
     else:
         return (100, 20, 20)
 
-def get_camera_angles(image, iterations = 1000, method = 'hough', refinement_iterations = 500):
+def get_camera_angles(image, iterations = 1000, method = 'hough', refinement_iterations = 500, optimizer = "random", seed = None):
     if method == 'hough':
         # Flip the image along the x and y axis
         gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
@@ -90,7 +392,8 @@ def get_camera_angles(image, iterations = 1000, method = 'hough', refinement_ite
     else:
         return None
     
-    return regress_lines(lines, iterations=iterations, refinement_iterations=refinement_iterations)[0]
+    arguments = dict(iterations=iterations, refinement_iterations=refinement_iterations) if optimizer == "random" else {}
+    return estimate_camera_angles(lines, optimizer, seed=seed, **arguments)[0]
 
 def get_focal_points(phi, theta):
     sc_points = [(1/(np.tan(theta)*np.sin(phi)), 1/np.tan(phi)),
@@ -100,6 +403,16 @@ def get_focal_points(phi, theta):
     # Its (1/ASPECT_RATIO * width/2 * p[0] + width/2, height/2 * p[1] + height) so height is used in both multiplications
     return [np.array([HEIGHT/2 * p[0] + WIDTH/2,  HEIGHT/2 * p[1] + HEIGHT/2]) for p in sc_points]
 
+def get_focal_points_batch(angles):
+    """get_focal_points of a (K,2) array of (phi, theta), as a (K,3,2) array"""
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 2)
+    phi, theta = angles[:, 0], angles[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sc_points = np.stack([np.stack([1/(np.tan(theta)*np.sin(phi)), 1/np.tan(phi)], axis=-1),
+                              np.stack([np.zeros_like(phi), - np.tan(phi)], axis=-1),
+                              np.stack([-np.tan(theta)/np.sin(phi), 1/np.tan(phi)], axis=-1)], axis=1)
+    return HEIGHT/2 * sc_points + np.array([WIDTH/2, HEIGHT/2])
+
 def get_focal_points_projection(phi, theta):
     # estimated method, use get_focal_points(phi,theta) for the analytical, more accurate solution
     # I used this function to debug my lookAt matrix and camera matrix
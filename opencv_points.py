@@ -3,6 +3,7 @@ import numpy as np
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 from itertools import combinations
+from consensus import CUBE_SYMMETRIES, rodriguesMatrices, alignRotations, chordalMean, rotationConsensus
 
 # points = [[-0.11, 1.17, 3.1], [-0.11, 1.17, 3.1],
 # [-3.76, 0.4, 5.61], [-3.76, 0.4, 5.61],
@@ -44,100 +45,135 @@ def orient_up(mat):
         return np.array([vy, vz, vx]).T
     return np.array([vz, vx, vy]).T
 
-def alignTrans(trans, threshold = 0.97, stop_early_percent = 0.8):
+def alignTrans(trans, threshold = 0.97):
     """
     Threshold, similarity that allows two transformations to be grouped together
-    stop_early_percent. if % of matrices are similar, return this group without going through all options.
+    The group is the consensus orientation from consensus.rotationConsensus, shown turned the way orient_up has it.
+    Returns (rotations, translations) of the group and of the rest, as (M,3,3) and (M,3) arrays.
     """
-    # Convert rodrigues vectors to matrices
-    mats = [(cv.Rodrigues(np.array(t[0]))[0], t[1]) for t in trans]
-    # Align matrices to (1, 0, 0), (0, 1, 0), (0, 0, 1)
-    mats = [(sorted(get_options(m[0]),key=get_comp(np.eye(3)))[-1], m[1]) for m in mats]
-    
-    # Get some common matrix
-    average_mat = sum([m[0] for m in mats])
-    x_temp = average_mat[:,0]/np.linalg.norm(average_mat[:,0])
-    y_temp = average_mat[:,1]/np.linalg.norm(average_mat[:,1])
-    average_mat = np.array([x_temp, y_temp, np.cross(x_temp, y_temp)]).T
-
-    max_list = []
-    not_in = []
-    max_amount = 0
-    # Overly complicated
-    for i in range(len(mats)):
-        mat_size = len(mats)
-        average_mat = orient_up(average_mat)
-        new_mats = [(sorted(get_options(t[0]),key=get_comp(average_mat))[-1], t[1]) for t in mats]
-        filtered_mats = [(m[0], m[1]) for m in new_mats if get_comp(average_mat)(m[0]) > threshold]
-        if len(filtered_mats) >= stop_early_percent * mat_size:
-            max_list = filtered_mats
-            not_in = [(m[0], m[1]) for m in new_mats if get_comp(average_mat)(m[0]) <= threshold]
-            max_amount = len(new_mats)
-            break
-        if DEBUG:
-            print("Failed to find good average_matrix, ", len(filtered_mats) / mat_size)
-        if len(filtered_mats) > max_amount:
-            max_list = new_mats
-            not_in = [(m[0], m[1]) for m in new_mats if get_comp(average_mat)(m[0]) <= threshold]
-            max_amount = len(new_mats)
-        average_mat = mats[i][0]
-
-    return max_list, not_in
+    rvecs = np.array([np.ravel(t[0]) for t in trans], dtype=np.float64).reshape(-1, 3)
+    translations = np.array([np.ravel(t[1]) for t in trans], dtype=np.float64).reshape(-1, 3)
+
+    rotations = rodriguesMatrices(rvecs)
+    mean, _, inliers = rotationConsensus(rotations, threshold)
+    mats, _ = alignRotations(rotations, orient_up(mean))
+    return (mats[inliers], translations[inliers]), (mats[~inliers], translations[~inliers])
 
 def matsToCubesWithCamera(mats, camera_mat):
     cam_inv = np.linalg.inv(camera_mat)
-    return [(cam_inv @ m[1]).ravel() for m in mats]
-
-def alignCubes(points):
-    
-    average_fract = [np.average([i - np.floor(i) for i in points[:,0]]), np.average([i - np.floor(i) for i in points[:,1]]),np.average([i - np.floor(i) for i in points[:,2]])]
-    if DEBUG:
-        print("average fractions:", average_fract)
-    # Define the vertices of the cube centered at (1, 2, 1) with side length 2
-    points = [[i+(0.5 - j) for i, j in zip(p,average_fract)] for p in points]
-    return points
-
-def alignCubesStochastic(points, iterations = 100):
-    best_fracts = [0, 0, 0]
-    best_losses = [100000, 100000, 100000]
-
-
-    for iter in range(iterations):
-        average_fract = [0,0,0]
-        for axis in range(3):
-            average_fract[axis] = np.random.rand()-0.5
-            new_points = [p[axis] + average_fract[axis] for p in points]
-            loss = sum([pow(p - np.floor(p) - 0.5, 2) for p in new_points])/len(new_points)
-            if loss < best_losses[axis]:
-                best_losses[axis] = loss
-                best_fracts[axis] = average_fract[axis]
-    # print("best fractions:", best_fracts)
-    # print("best losses:", best_losses)
-    return [[i+j for i, j in zip(p,best_fracts)] for p in points]
+    return [(cam_inv @ tvec).ravel() for tvec in mats[1]]
 
+def latticeOffsets(points, trim = 0.0, weights = None):
+    """
+    Per axis offset that moves (N,3) points closest to cube centres (half integers), in [-0.5, 0.5).
+    The fractional parts are angles on a circle, so the best offset comes from their circular mean.
+    trim: refit without this fraction of the points furthest from the lattice.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    weights = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(points) == 0:
+        return np.zeros(3)
+
+    def fit(weights):
+        phases = np.angle(np.sum(weights[:, None] * np.exp(2j * np.pi * points), axis=0)) / (2 * np.pi)
+        return np.mod(0.5 - phases + 0.5, 1) - 0.5
+
+    offsets = fit(weights)
+    if trim > 0:
+        # Distance of each point to its nearest cube centre, worst axis
+        shifted = points + offsets
+        residuals = np.abs(shifted - np.floor(shifted) - 0.5).max(axis=1)
+        keep = residuals <= np.quantile(residuals, 1 - trim)
+        offsets = fit(np.where(keep, weights, 0))
+    return offsets
+
+def snapToLattice(points, trim = 0.0, weights = None):
+    """Points moved by latticeOffsets, so cube centres fall on half integers"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    return points + latticeOffsets(points, trim, weights)
 
 def matsToCubes(mats):
     """
     Rotate all the cubes around the origin based on the rotation matrices of each,
     and average the cubes so that they fall in one block
+    mats: (rotations, translations) arrays as returned by alignTrans
     """
-    average_mat = sum([m[0] for m in mats])
-    x_temp = average_mat[:,0]/np.linalg.norm(average_mat[:,0])
-    y_temp = average_mat[:,1]/np.linalg.norm(average_mat[:,1])
-    average_mat = np.array([x_temp, y_temp, np.cross(x_temp, y_temp)]).T
+    rotations, translations = mats
+    if len(rotations) == 0:
+        return np.empty((0, 3))
+    # The symmetry of the average with the most upright z axis, of those the one with the smallest x[0][0]
+    options = chordalMean(rotations) @ CUBE_SYMMETRIES
+    upright = np.argsort(-options[:, 2, 2], kind='stable')[:4]
+    average_mat = options[upright[np.argmin(options[upright, 0, 0])]]
 
-    average_mat = sorted(sorted(get_options(average_mat),key=lambda x: -x[2][2])[0:4],key=lambda x: x[0][0])[0]
-
-    points = [t[1] for t in mats]
-    points = [(average_mat.T @ np.array(p)).ravel() for p in points]
-
-    points = np.array(points)
+    points = np.asarray(translations, dtype=np.float64).reshape(-1, 3) @ average_mat
 
     # Cubing
-    aligned_points = alignCubesStochastic(points)
+    return snapToLattice(points)
+
+# A cube shows at most this many faces to the camera
+MAX_VISIBLE_FACES = 3
 
-    points = np.array(aligned_points)
-    return points
+class VoxelStore:
+    """
+    Sparse voxel hash of cube centres, keyed by integer cell.
+    Every cell keeps its votes, the sum of the sub-cell offsets voted for it and the faces that voted.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.face_count = 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add(self, points, faces = None, weights = None):
+        """Votes (N,3) cube centres into their cells, faces are the ids recorded as support (running indices by default)"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        faces = np.arange(self.face_count, self.face_count + len(points)) if faces is None else np.asarray(faces)
+        weights = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.face_count += len(points)
+        if len(points) == 0:
+            return
+
+        cells = np.floor(points).astype(np.int64)
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        votes = np.bincount(inverse, weights=weights, minlength=len(unique))
+        offsets = np.stack([np.bincount(inverse, weights=weights * (points[:, axis] - cells[:, axis]), minlength=len(unique)) for axis in range(3)], axis=1)
+        order = np.argsort(inverse, kind='stable')
+        supporters = np.split(faces[order], np.cumsum(np.bincount(inverse, minlength=len(unique)))[:-1])
+
+        for cell, vote, offset, support in zip(map(tuple, unique), votes, offsets, supporters):
+            entry = self.cells.setdefault(cell, [0.0, np.zeros(3), []])
+            entry[0] += vote
+            entry[1] += offset
+            entry[2].extend(support.tolist())
+
+    def cubes(self, min_votes = 0):
+        """
+        Unique cubes as an (M,3) array of cell + mean offset, with (M,) confidences (votes out of MAX_VISIBLE_FACES, at most 1).
+        The cubes with the most votes come first.
+        """
+        entries = [(cell, entry) for cell, entry in self.cells.items() if entry[0] >= min_votes and entry[0] > 0]
+        if not entries:
+            return np.empty((0, 3)), np.empty(0)
+        votes = np.array([entry[0] for _, entry in entries])
+        entries = [entries[i] for i in np.argsort(-votes, kind='stable')]
+        cells = np.array([cell for cell, _ in entries], dtype=np.float64)
+        votes = np.array([entry[0] for _, entry in entries])
+        offsets = np.array([entry[1] for _, entry in entries]) / votes[:, None]
+        return cells + offsets, np.minimum(votes / MAX_VISIBLE_FACES, 1)
+
+    def support(self, cell):
+        """Ids of the faces that voted for the cell holding point cell"""
+        entry = self.cells.get(tuple(np.floor(np.asarray(cell, dtype=np.float64)).astype(np.int64).tolist()))
+        return [] if entry is None else list(entry[2])
+
+def uniqueCubes(points, min_votes = 0):
+    """One cube per occupied cell of (N,3) per face cube centres, with its confidence (see VoxelStore.cubes)"""
+    store = VoxelStore()
+    store.add(points)
+    return store.cubes(min_votes)
 
 def plot_cubes(points):
     fig = plt.figure()
@@ -195,7 +231,7 @@ if __name__ == "__main__":
 
     trans = [[[-1.86, -1.69, -0.9], [-1.83, 0.59, 3.96]], [[-1.81, -1.65, -0.87], [-1.76, -0.14, 3.02]], [[-1.66, 1.65, 0.39], [2.78, -0.63, 4.26]], [[1.81, 1.2, -0.51], [1.02, -0.33, 4.13]], [[-1.86, -1.85, -1.06], [0.86, -0.4, 3.8]], [[0.59, -1.7, -0.6], [0.97, -0.39, 3.94]], [[2.19, 0.02, -0.08], [-1.84, 0.08, 3.12]], [[1.76, 0.78, 1.51], [-2.06, -0.02, 3.85]], [[0.01, 2.65, 1.12], [1.79, -0.53, 3.91]], [[2.1, -0.36, 0.17], [1.8, -0.38, 3.94]]]
     mats, excluded = alignTrans(trans)
-    points = matsToCubes(mats)
+    points, confidence = uniqueCubes(matsToCubes(mats))
     plot_cubes(points)
     
     
\ No newline at end of file
@@ -6,110 +6,200 @@ import matplotlib.pyplot as plt
 import sys
 from graph import *
 from util import *
-from opencv_points import matsToCubes, plot_cubes, alignTrans
+from util import _expandRanges
+from opencv_points import matsToCubes, plot_cubes, alignTrans, uniqueCubes
 from opencv_fit_color import *
 from opencv import lsd, prob, drawGraphPipeline, drawEdges, drawLinesColorful
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 #
 # New pipeline
 #
 def edges_to_polar_lines(edges):
-    return np.array([(np.sign(np.arctan2(b[0] - a[0], b[1] - a[1]))*(a[1]*b[0]-b[1]*a[0])/np.linalg.norm(b-a), np.fmod(-np.arctan2(b[0] - a[0], b[1] - a[1]) + np.pi,np.pi)) for a, b in edges])
-
-def classifyEdges(edges, threshold_multiplier = 1.2):
+    edges = np.asarray(edges, dtype=np.float64).reshape(-1, 2, 2)
+    a, b = edges[:, 0], edges[:, 1]
+    angle = np.arctan2(b[:, 0] - a[:, 0], b[:, 1] - a[:, 1])
+    rho = np.sign(angle) * (a[:, 1]*b[:, 0] - b[:, 1]*a[:, 0]) / np.linalg.norm(b - a, axis=-1)
+    return np.stack([rho, np.fmod(-angle + np.pi, np.pi)], axis=-1)
+
+# Arguments for the camera angle searches that need more than their defaults
+OPTIMIZER_ARGUMENTS = {
+    "random": dict(iterations=1000, refinement_iterations=500, refinement_area=np.deg2rad(15)),
+}
+
+# Searches that can weight the lines, by segment length
+WEIGHTED_OPTIMIZERS = {"gaussian_sphere"}
+
+def optimizerArguments(optimizer, edges = None):
+    arguments = dict(OPTIMIZER_ARGUMENTS.get(optimizer, {}))
+    if edges is not None and optimizer in WEIGHTED_OPTIMIZERS:
+        arguments["weights"] = SegmentArray(edges).lengths
+    return arguments
+
+def cameraAngles(lines, optimizer = "coarse_to_fine", seed = None, edges = None):
+    return estimate_camera_angles(lines, optimizer, seed=seed, **optimizerArguments(optimizer, edges))
+
+def labelEdges(edges, threshold_multiplier = 1.2, optimizer = "coarse_to_fine", seed = None, tracker = None):
+    """
+    Vanishing point of every edge, as an integer label array (0, 1, 2 for x, y, z and -1 for none) with the
+    index arrays of the x, y and z edges. With a VanishingPointTracker the camera angles are tracked from the previous frame
+    and optimizer is ignored in favour of the tracker's method.
+    Returns labels, (x, y, z) indices, phi, theta
+    """
+    edges = np.asarray(edges, dtype=np.float64).reshape(-1, 2, 2)
     lines = edges_to_polar_lines(edges)
 
     # Get camera angles
-    phi_theta, loss = regress_lines(lines, iterations=1000, refinement_iterations=500, refinement_area=np.deg2rad(15))
+    if tracker is not None:
+        phi_theta, loss = tracker.update(lines, seed, **optimizerArguments(tracker.method, edges))
+    else:
+        phi_theta, loss = cameraAngles(lines, optimizer, seed, edges)
     phi, theta = phi_theta
-    focal_points = get_focal_points(phi, theta)
 
-    pairs = [(edge, which_line(focal_points, line, threshold = loss * threshold_multiplier)) for edge, line in zip(edges, lines)]
-    x_edges = [line for line, which in pairs if which == "x"]
-    y_edges = [line for line, which in pairs if which == "y"]
-    z_edges = [line for line, which in pairs if which == "z"]
-    
+    labels = line_labels(phi_theta, lines, threshold = loss * threshold_multiplier)[0]
+    return labels, edgeFamilies(labels), phi, theta
+
+def edgeFamilies(labels):
+    """Index arrays of the x, y and z edges in a label array from labelEdges"""
+    return tuple(np.flatnonzero(labels == axis) for axis in range(3))
+
+def selectEdges(edges, *families):
+    """The families as they are, or the rows of edges they index when edges is given"""
+    if edges is None:
+        return families
+    edges = np.asarray(edges, dtype=np.float64).reshape(-1, 2, 2)
+    return tuple(edges[np.asarray(family, dtype=np.int64)] for family in families)
+
+def classifyEdges(edges, threshold_multiplier = 1.2, optimizer = "coarse_to_fine", seed = None, tracker = None):
+    """labelEdges, but with the x, y and z edges as (N,2,2) arrays"""
+    _, families, phi, theta = labelEdges(edges, threshold_multiplier, optimizer, seed, tracker)
+    x_edges, y_edges, z_edges = selectEdges(edges, *families)
     return x_edges, y_edges, z_edges, phi, theta
 
-def _splitEdges(base, cutters, threshold = 0.1):
-    new_edges = []
-    for edge in base:
-        intersection = None
-        for other_edge in cutters:
-            t, s = get_segments_intersection(*edge, *other_edge)
-            if s is None or t is None:
-                continue
-            if s > -threshold and s < 1 + threshold and t >= 0.19 and t <= 0.81:
-                intersection = edge[0] + t * (edge[1] - edge[0])
-                break
-    
-        if intersection is not None:
-            new_edges.append([edge[0], intersection])
-            new_edges.append([intersection, edge[1]])
-            continue
-        new_edges.append(edge)
-    return new_edges
-
-def splitEdges(x_edges, y_edges, z_edges, threshold = 0.1):
-    return _splitEdges(x_edges, y_edges+z_edges, threshold), _splitEdges(y_edges, z_edges+x_edges, threshold), _splitEdges(z_edges, x_edges+y_edges, threshold)
+def _splitEdges(base, cutters, threshold = 0.1, min_gap = 0.05):
+    """
+    Splits every base edge at each cutter that crosses it between 19% and 81% of its length,
+    where the cutter may miss by threshold of its own length. Runs of crossings less than min_gap apart count once.
+    Returns the pieces as an (N,2,2) array, in base order.
+    """
+    base = np.asarray(base, dtype=np.float64).reshape(-1, 2, 2)
+    cutters = np.asarray(cutters, dtype=np.float64).reshape(-1, 2, 2)
+    if len(base) == 0 or len(cutters) == 0:
+        return base.copy()
+
+    t, s = segmentParams(base[:, None], cutters[None, :])
+    with np.errstate(invalid='ignore'):
+        qualifies = (s > -threshold) & (s < 1 + threshold) & (t >= 0.19) & (t <= 0.81)
+    edge, _ = np.nonzero(qualifies)
+    cuts = t[qualifies]
+    order = np.lexsort((cuts, edge))
+    edge, cuts = edge[order], cuts[order]
+    keep = np.ones(len(cuts), dtype=bool)
+    keep[1:] = (edge[1:] != edge[:-1]) | (np.diff(cuts) >= min_gap)
+    edge, cuts = edge[keep], cuts[keep]
+
+    # Every edge becomes the pieces between its sorted knots 0, cuts..., 1
+    indices = np.arange(len(base))
+    knot_edge = np.concatenate([indices, edge, indices])
+    knot_t = np.concatenate([np.zeros(len(base)), cuts, np.ones(len(base))])
+    order = np.lexsort((knot_t, knot_edge))
+    knot_edge, knot_t = knot_edge[order], knot_t[order]
+    points = base[knot_edge, 0] + knot_t[:, None] * (base[knot_edge, 1] - base[knot_edge, 0])
+    piece = knot_edge[1:] == knot_edge[:-1]
+    return np.stack([points[:-1][piece], points[1:][piece]], axis=1)
+
+def splitEdges(x_edges, y_edges, z_edges, threshold = 0.1, edges = None):
+    x_edges, y_edges, z_edges = selectEdges(edges, x_edges, y_edges, z_edges)
+    return _splitEdges(x_edges, stackSegments(y_edges, z_edges), threshold), _splitEdges(y_edges, stackSegments(z_edges, x_edges), threshold), _splitEdges(z_edges, stackSegments(x_edges, y_edges), threshold)
         
-def smoothEdges(x_edges,y_edges,z_edges):
+def smoothEdges(x_edges,y_edges,z_edges, edges = None):
+    x_edges, y_edges, z_edges = selectEdges(edges, x_edges, y_edges, z_edges)
     x_edges = combineParallelLines(x_edges)
     y_edges = combineParallelLines(y_edges)
     z_edges = combineParallelLines(z_edges)         
     return x_edges, y_edges, z_edges
 
-def get_faces_from_pairs(edges1, edges2, threshold = 15):
-    faces = []
-    indices = []
-    for i in range(len(edges1)):
-        e1 = edges1[i]
-        for j in range(len(edges2)):
-            e2 = edges2[j]
-            if segments_distance(*e1, *e2) > threshold:
-                continue
-            for k in range(i + 1, len(edges1)):
-                e3 = edges1[k]
-                if segments_distance(*e2, *e3) > threshold:
-                    continue
-                for l in range(j + 1, len(edges2)):
-                    e4 = edges2[l]
-                    if segments_distance(*e3, *e4) > threshold or segments_distance(*e4, *e1) > threshold:
-                        continue
-
-                    # Eliminate duplicate faces:
-                    indices.append((i, j, k, l))
-                    faces.append([lineIntersection(*e1, *e2), lineIntersection(*e2, *e3), lineIntersection(*e3, *e4), lineIntersection(*e4, *e1)])         
-    new_faces = []
-    banned_faces = []
-    for a, edge_numbers, face in zip(range(len(faces)), indices, faces):
-        if edge_numbers in banned_faces:
-            continue
-        accepted = True
-        for b, edge_numbers2, face2 in list(zip(range(len(faces)), indices, faces))[a+1:]:
-            # Two faces share two edges.
-            if (edge_numbers[0], edge_numbers[2]) == (edge_numbers2[0], edge_numbers2[2]) or (edge_numbers[1], edge_numbers[3]) == (edge_numbers2[1], edge_numbers2[3]):
-                # They overlap (significantly)
-                if pointInConvexPolygon(sum([np.array(f) for f in face])/4, face2) or pointInConvexPolygon(sum([np.array(f) for f in face2])/4, face):
-                    
-                    if faceCircumference(face) > faceCircumference(face2):
-                        accepted = False
-                        break
-                    else:
-                        banned_faces.append(face2)
-        if accepted:
-            new_faces.append(face)
-
-    # Orient clockwise
-    new_new_faces = []
-    for face in new_faces:
-        e1 = [face[1][0] - face[0][0], face[1][1] - face[0][1]]
-        e2 = [face[2][0] - face[1][0], face[2][1] - face[1][1]]
-        if e1[0]*e2[0] - e1[1]*e2[0] < 0:
-            new_new_faces.append(face)
-        else:
-            new_new_faces.append(face[::-1])
-    return new_new_faces
+def _quadCycles(proximity):
+    """
+    (Q,4) rows (i, j, k, l) with i < k and j < l where (i,j), (k,j), (k,l) and (i,l) are all close in the
+    boolean proximity matrix, in (i, j, k, l) order.
+    """
+    n1, n2 = proximity.shape
+    # Rows sharing at least two columns, from the common neighbour counts
+    common = proximity.astype(np.int64) @ proximity.T.astype(np.int64)
+    i, k = np.nonzero(np.triu(common >= 2, 1))
+
+    upper = np.triu(np.ones((n2, n2), dtype=bool), 1)
+    chunk = max(1, (1 << 22) // max(1, n2 * n2))
+    quads = [np.empty((0, 4), dtype=np.int64)]
+    for start in range(0, len(i), chunk):
+        shared = proximity[i[start:start + chunk]] & proximity[k[start:start + chunk]]
+        c, j, l = np.nonzero(shared[:, :, None] & shared[:, None, :] & upper)
+        quads.append(np.stack([i[start + c], j, k[start + c], l], axis=-1))
+    quads = np.concatenate(quads)
+    return quads[np.lexsort(quads.T[::-1])]
+
+def _overlapDuplicates(quads, faces):
+    """
+    Faces that overlap another face built on the same two edges of either family with a smaller circumference.
+    Faces are grouped by the (i, k) and (j, l) index pairs, so only faces in the same group are compared.
+    """
+    circumference = np.linalg.norm(faces - np.roll(faces, 1, axis=1), axis=-1).sum(axis=1)
+    centers = faces.mean(axis=1)
+    dropped = np.zeros(len(faces), dtype=bool)
+    for first, second in ((0, 2), (1, 3)):
+        key = quads[:, first] * (quads[:, second].max(initial=0) + 1) + quads[:, second]
+        order = np.argsort(key, kind='stable')
+        _, group_start, group_size = np.unique(key[order], return_index=True, return_counts=True)
+        lo = np.repeat(group_start, group_size)
+        partners, counts = _expandRanges(lo, lo + np.repeat(group_size, group_size))
+        a, b = np.repeat(order, counts), order[partners]
+        a, b = a[a != b], b[a != b]
+
+        overlapping = pointsInConvexPolygons(centers[a], faces[b]) | pointsInConvexPolygons(centers[b], faces[a])
+        smaller = (circumference[b] < circumference[a]) | ((circumference[b] == circumference[a]) & (b < a))
+        dropped[a[overlapping & smaller]] = True
+    return dropped
+
+def get_faces_from_pairs(edges1, edges2, threshold = 15, edges = None):
+    """
+    Quadrilaterals made of two edges of each family, where every edge is within threshold of the next.
+    Returns an (F,4,2) array of corners, oriented clockwise.
+    """
+    edges1, edges2 = selectEdges(edges, edges1, edges2)
+    edges1 = np.asarray(edges1, dtype=np.float64).reshape(-1, 2, 2)
+    edges2 = np.asarray(edges2, dtype=np.float64).reshape(-1, 2, 2)
+    if len(edges1) < 2 or len(edges2) < 2:
+        return np.empty((0, 4, 2))
+
+    proximity = SegmentArray(edges1).distance_matrix(edges2) <= threshold
+    quads = _quadCycles(proximity)
+
+    # Corners are where the lines through the edges meet
+    t, _ = segmentParams(edges1[:, None], edges2[None, :])
+    corners = edges1[:, None, 0] + t[..., None] * (edges1[:, None, 1] - edges1[:, None, 0])
+    i, j, k, l = quads.T
+    faces = np.stack([corners[i, j], corners[k, j], corners[k, l], corners[i, l]], axis=1)
+    parallel = np.isnan(faces).any(axis=(1, 2))
+    quads, faces = quads[~parallel], faces[~parallel]
+
+    # Eliminate duplicate faces
+    faces = faces[~_overlapDuplicates(quads, faces)]
+
+    # Orient clockwise, by the sign of the shoelace area so bent quads turn the same way as the rest
+    following = np.roll(faces, -1, axis=1)
+    counter = (faces[..., 0] * following[..., 1] - faces[..., 1] * following[..., 0]).sum(axis=1) >= 0
+    faces[counter] = faces[counter, ::-1]
+    return faces
+
+def facesFromFamilies(x_edges, y_edges, z_edges, edges = None, threshold = 15):
+    """get_faces_from_pairs for the three axis planes concurrently, returns xfaces, yfaces, zfaces"""
+    x_edges, y_edges, z_edges = selectEdges(edges, x_edges, y_edges, z_edges)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        xfaces = pool.submit(get_faces_from_pairs, z_edges, y_edges, threshold)
+        yfaces = pool.submit(get_faces_from_pairs, x_edges, z_edges, threshold)
+        zfaces = pool.submit(get_faces_from_pairs, x_edges, y_edges, threshold)
+        return xfaces.result(), yfaces.result(), zfaces.result()
 
 def drawFaces(image, faces, color, shrink_factor = 0.75):
     for face in faces:
@@ -167,11 +257,11 @@ def drawFocalPointsPipeline(image, edges):
     # drawEdges(image, x_edges, (0, 0, 255),3)
     # drawEdges(image, y_edges, (0, 255, 0),3)
     # drawEdges(image, z_edges, (255, 0, 0),3)
-    # drawLinesColorful(original_image.copy(), x_edges + y_edges + z_edges, "colorful")
+    # drawLinesColorful(original_image.copy(), stackSegments(x_edges, y_edges, z_edges), "colorful")
 
     threshold = 0.1
     x_edges, y_edges, z_edges = splitEdges(x_edges, y_edges, z_edges, threshold)   
-    drawLinesColorful(original_image.copy(), x_edges + y_edges + z_edges, "Detected edges in image")
+    drawLinesColorful(original_image.copy(), stackSegments(x_edges, y_edges, z_edges), "Detected edges in image")
     
     zfaces=get_faces_from_pairs(x_edges, y_edges)
     yfaces=get_faces_from_pairs(z_edges, x_edges)
@@ -190,9 +280,9 @@ def drawFocalPointsPipeline(image, edges):
     draw3dEdges(edges_3d)
     print(edges_3d)
     # MAts method
-    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, zfaces, "z", 9000000))
-    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, xfaces, "x", 9000000))
-    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, yfaces, "y", 9000000))
+    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, zfaces, "z"))
+    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, xfaces, "x"))
+    # drawMats(original_image.copy(), handleClassifiedFaces(phi, theta, yfaces, "y"))
 
      # Edge numbers
     # drawEdgeNumbers(original_image.copy(), x_edges, y_edges, z_edges)
@@ -207,39 +297,63 @@ def drawEdgeNumbers(image, x_edges, y_edges, z_edges ):
         cv.putText(image, str(i), (int((edge[0][0] + edge[1][0])/2), int((edge[0][1] + edge[1][1])/2)), cv.FONT_HERSHEY_SIMPLEX, 0.5, (150, 0, 0), 1)
     cv.imshow("Edge numbers", image)
 
-def handleClassifiedFaces(phi, theta, zfaces, axis, LENGTH = 9000000):
-    def randomsign():
-        return 1 if np.random.rand() > 0.5 else -1
-    if axis == "z":
-        shape = [[0,0,0],[0,1,0],[1,1,0],[1,0,0]]
-    elif axis == "y":
-        shape = [[0,0,0],[1,0,0],[1,0,1],[0,0,1]]
-    else:
-        shape = [[0,0,0],[0,0,1],[0,1,1],[0,1,0]]
-    camera_matrix = getIntrinsicsMatrix()
-    focal_points = get_focal_points(phi, theta)
-    length = LENGTH
-    object_points = np.array([[-length,0,0],[0,length,0],[0,0,length]] + shape, dtype=np.float32)
-    mats = []
-    for face in zfaces:
-        for iter in range(50):
-            # Face needs to be clockwise!!
-            image_points = [focal_points + face]
-            rand_object_point =  np.array([[randomsign()*a for a in p] for p in [[-length,0,0],[0,length,0],[0,0,length]]] + shape,dtype=np.float32)
-            rand_image_point = image_points[::randomsign()]
-            offset = np.random.randint(0,3)
-            rand_image_point = np.array(image_points[offset:] + image_points[:offset],dtype=np.float32)
-            ret, rvec, tvec = cv.solvePnP(rand_object_point, rand_image_point, camera_matrix, None)
-            tvec = np.array(tvec)
-            rvec = np.array(rvec)
-            if np.linalg.norm(tvec) < 1000 and np.linalg.norm(tvec) > 0.01:
-                break
-        mats.append((rvec, tvec))
-
-    return mats
-
-def justMatPlotPipeline(image, edges):
-    phi_theta, loss = regress_lines(edges_to_polar_lines(edges), iterations=1000, refinement_iterations=500, refinement_area=np.deg2rad(15))
+# Unit squares the faces of each axis are matched to, corner for corner
+CLASSIFIED_FACE_SHAPES = {
+    "z": np.array([[0,0,0],[0,1,0],[1,1,0],[1,0,0]], dtype=np.float64),
+    "y": np.array([[0,0,0],[1,0,0],[1,0,1],[0,0,1]], dtype=np.float64),
+    "x": np.array([[0,0,0],[0,0,1],[0,1,1],[0,1,0]], dtype=np.float64),
+}
+
+def vanishingRotations(phi, theta):
+    """The (4,3,3) proper rotations whose columns point at the three vanishing points, one per choice of axis signs"""
+    directions = vanishing_directions((phi, theta))[0]
+    signs = np.array(list(itertools.product([-1, 1], repeat=3)))
+    rotations = directions.T[None] * signs[:, None, :]
+    return rotations[np.linalg.det(rotations) > 0]
+
+def solveClassifiedFacePoses(phi, theta, faces, axis, camera_matrix = None, max_distance = 1000):
+    """
+    Poses of the unit square faces of one axis from an (F,4,2) array of their corners, all at once.
+    The rotation comes from the vanishing points, so only the translation is left: a linear least squares
+    problem per face, solved for every axis sign choice and corner offset. The hypothesis with the smallest
+    residual that keeps the face in front of the camera (and within max_distance) wins.
+    Returns (F,3,3) rotations, (F,3) translations and an (F,) mask of the faces that gave a valid pose.
+    """
+    if camera_matrix is None:
+        camera_matrix = getIntrinsicsMatrix()
+    faces = np.asarray(faces, dtype=np.float64).reshape(-1, 4, 2)
+    shape = CLASSIFIED_FACE_SHAPES[axis]
+
+    # Hypotheses: every rotation with every cyclic corner offset
+    rotations = vanishingRotations(phi, theta)
+    shapes = np.stack([np.roll(shape, -offset, axis=0) for offset in range(4)])
+    rotations, shapes = np.repeat(rotations, len(shapes), axis=0), np.tile(shapes, (len(rotations), 1, 1))
+    rotated = np.einsum('hij,hpj->hpi', rotations, shapes)
+
+    # x (R X + t)_z = (R X + t)_x and the same for y, two rows per corner
+    normalized = (faces - camera_matrix[:2, 2]) / np.diag(camera_matrix)[:2]
+    x, y = normalized[..., 0], normalized[..., 1]
+    ones, zeros = np.ones_like(x), np.zeros_like(x)
+    A = np.concatenate([np.stack([ones, zeros, -x], axis=-1), np.stack([zeros, ones, -y], axis=-1)], axis=1)
+    b = -np.concatenate([rotated[None, :, :, 0] - x[:, None] * rotated[None, :, :, 2],
+                         rotated[None, :, :, 1] - y[:, None] * rotated[None, :, :, 2]], axis=2)
+    translations = np.einsum('fij,fhj->fhi', np.linalg.pinv(A), b)
+    residuals = np.sum((np.einsum('fij,fhj->fhi', A, translations) - b) ** 2, axis=-1)
+
+    depths = rotated[None, :, :, 2] + translations[:, :, None, 2]
+    distances = np.linalg.norm(translations, axis=-1)
+    possible = np.all(depths > 0, axis=-1) & (distances > 0.01) & (distances < max_distance)
+    best = np.argmin(np.where(possible, residuals, np.inf), axis=1)
+    faces_index = np.arange(len(faces))
+    return rotations[best], translations[faces_index, best], possible[faces_index, best]
+
+def handleClassifiedFaces(phi, theta, zfaces, axis):
+    """solveClassifiedFacePoses as a list of (rvec, tvec) for the faces that gave a pose"""
+    rotations, translations, valid = solveClassifiedFacePoses(phi, theta, zfaces, axis)
+    return [(cv.Rodrigues(rotation)[0].ravel(), translation) for rotation, translation in zip(rotations[valid], translations[valid])]
+
+def justMatPlotPipeline(image, edges, optimizer = "coarse_to_fine"):
+    phi_theta, loss = cameraAngles(edges_to_polar_lines(edges), optimizer, edges=edges)
     phi, theta = phi_theta
     draw_vanishing_points_plots(edges_to_polar_lines(edges), phi, theta, show=False)
     plt.show()
@@ -262,23 +376,19 @@ def facesToTrans(xfaces, yfaces,zfaces, phi, theta):
     return points
 
 
-def getCubesVP(edges):
-    x_edges, y_edges, z_edges, phi, theta = classifyEdges(edges, 1.2)
-    x_edges, y_edges, z_edges = smoothEdges(x_edges, y_edges, z_edges)
-    zfaces=get_faces_from_pairs(x_edges, y_edges)
-    yfaces=get_faces_from_pairs(x_edges, z_edges)
-    xfaces=get_faces_from_pairs(z_edges, y_edges)
+def getCubesVP(edges, tracker = None):
+    _, (x_edges, y_edges, z_edges), phi, theta = labelEdges(edges, 1.2, tracker=tracker)
+    x_edges, y_edges, z_edges = smoothEdges(x_edges, y_edges, z_edges, edges=edges)
+    xfaces, yfaces, zfaces = facesFromFamilies(x_edges, y_edges, z_edges)
     centers = facesToTrans(xfaces, yfaces, zfaces, phi, theta)
     return centers
 
 from opencv import handleFaces
-def getCubesMixed(edges):
-    x_edges, y_edges, z_edges, phi, theta = classifyEdges(edges, 1.2)
-    x_edges, y_edges, z_edges = smoothEdges(x_edges, y_edges, z_edges)
-    zfaces=get_faces_from_pairs(x_edges, y_edges)
-    yfaces=get_faces_from_pairs(x_edges, z_edges)
-    xfaces=get_faces_from_pairs(z_edges, y_edges)
-    trans = handleFaces([np.array(face,dtype=np.float32) for face in xfaces + yfaces + zfaces])
+def getCubesMixed(edges, tracker = None):
+    _, (x_edges, y_edges, z_edges), phi, theta = labelEdges(edges, 1.2, tracker=tracker)
+    x_edges, y_edges, z_edges = smoothEdges(x_edges, y_edges, z_edges, edges=edges)
+    xfaces, yfaces, zfaces = facesFromFamilies(x_edges, y_edges, z_edges)
+    trans = handleFaces(np.concatenate([xfaces, yfaces, zfaces]).astype(np.float32))
     return trans
 
 def drawMixedPipeline(image, edges):
@@ -301,11 +411,11 @@ def drawMixedPipeline(image, edges):
     drawEdges(image, x_edges, (0, 0, 255),3)
     drawEdges(image, y_edges, (0, 255, 0),3)
     drawEdges(image, z_edges, (255, 0, 0),3)
-    drawLinesColorful(original_image.copy(), x_edges + y_edges + z_edges, "colorful")
+    drawLinesColorful(original_image.copy(), stackSegments(x_edges, y_edges, z_edges), "colorful")
 
     threshold = 0.1
     x_edges, y_edges, z_edges = splitEdges(x_edges, y_edges, z_edges, threshold)   
-    drawLinesColorful(original_image.copy(), x_edges + y_edges + z_edges, "colorful_split")
+    drawLinesColorful(original_image.copy(), stackSegments(x_edges, y_edges, z_edges), "colorful_split")
     
     zfaces=get_faces_from_pairs(x_edges, y_edges)
     yfaces=get_faces_from_pairs(z_edges, x_edges)
@@ -317,10 +427,10 @@ def drawMixedPipeline(image, edges):
     cv.imshow("Connected Edges", image)
 
     
-    trans = handleFaces([np.array(face,dtype=np.float32) for face in xfaces + yfaces + zfaces])
+    trans = handleFaces(np.concatenate([xfaces, yfaces, zfaces]).astype(np.float32))
     mats, excluded_mats = alignTrans(trans)
 
-    points = matsToCubes(mats)
+    points, confidence = uniqueCubes(matsToCubes(mats))
     plot_cubes(points)
     
 
@@ -335,9 +445,8 @@ def pixelToPlane(pixel,camera_intrinsics = None, projection_matrix = None):
     screen_point = np.linalg.inv(projection_matrix) @ np.linalg.inv(camera_intrinsics) @ np.array([pixel[0], pixel[1], 1])
     return np.array([-screen_point[0], -screen_point[1], 1])
 
-def rotateScreen(screen_point, phi, theta):
-    
-    rotation_matrix = np.array([
+def screenRotation(phi, theta):
+    return np.array([
         [np.cos(theta), 0, -np.sin(theta)],
         [0, 1, 0],
         [np.sin(theta), 0, np.cos(theta)]
@@ -346,7 +455,9 @@ def rotateScreen(screen_point, phi, theta):
         [0,np.cos(phi), -np.sin(phi)],
         [0,np.sin(phi), np.cos(phi)]
     ])
-    return rotation_matrix @ screen_point
+
+def rotateScreen(screen_point, phi, theta):
+    return screenRotation(phi, theta) @ screen_point
 
 def cartesianToPolar(vector):
     phi = np.arctan2(vector[1], vector[0])
@@ -383,28 +494,44 @@ def edgeTo3D(edge, axis, camera_phi, camera_theta):
         return None
     return [p1, p2]
 
+# Scene axis of each edge family and the scale its back projected edges get, in edgesTo3D order
+EDGE_FAMILY_AXES = {
+    "y": (np.array([0, 1, 0]), 1),
+    "x": (np.array([-1, 0, 0]), 1),
+    "z": (np.array([0, 0, 1]), 1/1.5),
+}
+
+def backProjectEdges(camera_phi, camera_theta, x_edges, y_edges, z_edges, max_length = 10):
+    """
+    edgeTo3D for every edge of the three families at once, with the screen to scene transform built once.
+    Returns an (N,2,3) array of the y, x and z edges in that order and an (N,) mask,
+    False where edgeTo3D would have returned None or the triangle is degenerate.
+    """
+    camera_intrinsics = getIntrinsicsMatrix()
+    projection_matrix = np.eye(3)
+    projection_matrix[0,0] = camera_intrinsics[0,2] / camera_intrinsics[1,2]
+    # pixelToPlane and rotateScreen as one matrix
+    transform = screenRotation(-(np.pi/2 - camera_phi), -camera_theta) @ np.diag([-1, -1, 1]) @ np.linalg.inv(projection_matrix) @ np.linalg.inv(camera_intrinsics)
+
+    families = {"x": x_edges, "y": y_edges, "z": z_edges}
+    edges = [np.asarray(families[axis], dtype=np.float64).reshape(-1, 2, 2) for axis in EDGE_FAMILY_AXES]
+    third_sides = np.concatenate([np.repeat(side[None], len(family), axis=0) for (side, _), family in zip(EDGE_FAMILY_AXES.values(), edges)])
+    scales = np.concatenate([np.full(len(family), scale) for (_, scale), family in zip(EDGE_FAMILY_AXES.values(), edges)])
+    edges = np.concatenate(edges)
+
+    rays = np.concatenate([edges, np.ones(edges.shape[:2] + (1,))], axis=-1) @ transform.T
+    directions = rays / np.linalg.norm(rays, axis=-1, keepdims=True)
+    # Triangle ORIGIN A B with the third side along the family's axis
+    original_angle = np.arccos(np.clip(np.sum(directions[:, 0] * directions[:, 1], axis=-1), -1, 1))
+    side_angles = np.arccos(np.clip(directions @ third_sides[..., None], -1, 1))[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lengths = np.sin(side_angles[:, ::-1]) / np.sin(original_angle)[:, None]
+    valid = np.all(np.isfinite(lengths) & (lengths <= max_length), axis=-1)
+    return directions * (lengths * scales[:, None])[..., None], valid
+
 def edgesTo3D(camera_phi, camera_theta, x_edges, y_edges, z_edges):
-    camera_phi = np.pi/2 - camera_phi
-    edges_3d = []
-    for edge in y_edges:
-        # Triangle ORIGIN A B
-        edge = edgeTo3D(edge, "y", camera_phi, camera_theta)
-        if edge is not None:
-            edges_3d.append(edge)
-        
-    for edge in x_edges:
-        # Triangle ORIGIN A B
-        edge = edgeTo3D(edge, "x", camera_phi, camera_theta)
-        if edge is not None:
-            edges_3d.append(edge)
-
-    for edge in z_edges:
-        #Triangle ORIGIN A B
-        edge = edgeTo3D(edge, "z", camera_phi, camera_theta)
-        if edge is not None:
-            edge = [edge[0]/1.5, edge[1]/1.5]
-            edges_3d.append(edge)
-    return edges_3d
+    edges_3d, valid = backProjectEdges(camera_phi, camera_theta, x_edges, y_edges, z_edges)
+    return edges_3d[valid]
 
 def getEdgesVP(edges):
     x_edges, y_edges, z_edges, phi, theta = classifyEdges(edges, 1.2)
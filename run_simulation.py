@@ -8,7 +8,8 @@ from opencv import postProcessFbo, postProcessCubesFbo, exportFbo, cubesToWorld,
 from constants import loadConstants
 from texture import do_pass
 import itertools
-from opencv_renewed import getCubesVP
+from opencv_renewed import getCubesVP, getCubesMixed
+from opencv_fit_color import VanishingPointTracker
 
 class GraphicsEngine:
     def __init__(self, win_size=(600, 400)):
@@ -42,6 +43,8 @@ class GraphicsEngine:
         self.SHOW_HOUGH = True
         self.PAUSED = False
         self.EXPORT = False
+        # camera angles carried over between processed frames
+        self.vp_tracker = VanishingPointTracker()
 
         # light
         self.light = Light()
@@ -68,6 +71,9 @@ class GraphicsEngine:
         if event.key == pg.K_g:
             self.EXPORT = True
             self.EXPORT_REASON = "process"
+        if event.key == pg.K_v:
+            self.EXPORT = True
+            self.EXPORT_REASON = "vanishing"
         if event.key == pg.K_b:
             self.scene.clear_objects(MarkerCube(self))
         if event.key == pg.K_p:
@@ -135,6 +141,10 @@ class GraphicsEngine:
 
                 # for c in newcubes:
                 #     self.scene.add_object(MarkerCube(self, pos=c))
+            elif self.EXPORT_REASON == "vanishing":
+                newcubes = postProcessCubesFbo(self, self.buffers.screen, display=True, pipelineFunc=lambda edges: getCubesMixed(edges, self.vp_tracker))
+                newcubes = cubesToWorld(newcubes, self.camera)
+                print("guessing cube positions (relative to camera): " + str(newcubes))
         pg.display.flip()
 
     def render_pipeline(self):
@@ -194,6 +204,7 @@ def run():
     print("T - export current frame as 'generated_images/output.png'")
     print("Y - Print camera matrix and cube positions")
     print("G - Process the current frame directly")
+    print("V - Process the current frame with the vanishing point method, tracking the camera angles from the last V press")
     app = GraphicsEngine()
     app.run()
 if __name__ == '__main__':
@@ -0,0 +1,58 @@
+import cv2 as cv
+import numpy as np
+import pytest
+from graph import Graph, getFaces
+from opencv import lsd, linesToPlanarGraph
+
+def test_shallow_corner_quad():
+    # A quadrilateral whose corner at (100, 0) bends by only ~11 degrees is still a face
+    g = Graph()
+    corners = [g.add_vertex(p) for p in [(0, 0), (100, 0), (200, 20), (0, 100)]]
+    for a, b in zip(corners, corners[1:] + corners[:1]):
+        g.add_edge(a, b)
+    assert len(getFaces(g)) == 1
+
+def test_sc_cube_faces():
+    # The three visible faces of the single cube, including the right face with a shallow corner
+    image = cv.imread('generated_images/sc_cube.png')
+    assert len(getFaces(linesToPlanarGraph(lsd(image, 2, scale=0.5)))) == 3
+
+def _searchCycles(graph, start, path, corners, collinear_cos = 0.95):
+    """
+    The old getFaces search: 4-cycles through neighbours, where a straight continuation may replace the last corner.
+    Yields (corners, path) with path every vertex walked through.
+    """
+    if len(corners) == 4:
+        if start in graph.get_neighbors(corners[-1]):
+            yield corners, path
+        return
+    for neighbor in graph.get_neighbors(path[-1]):
+        if neighbor in path:
+            continue
+        yield from _searchCycles(graph, start, path + [neighbor], corners + [neighbor], collinear_cos)
+        if len(corners) >= 2:
+            incoming = graph.get_vertex(path[-1]) - graph.get_vertex(corners[-2])
+            outgoing = graph.get_vertex(neighbor) - graph.get_vertex(path[-1])
+            if np.dot(incoming, outgoing) / (np.linalg.norm(incoming) * np.linalg.norm(outgoing)) > collinear_cos:
+                yield from _searchCycles(graph, start, path + [neighbor], corners[:-1] + [neighbor], collinear_cos)
+
+def _faceKey(points):
+    return frozenset(map(tuple, np.round(points, 3)))
+
+@pytest.mark.parametrize("name", ["demo_rgb", "old_sc_inf", "sc_white_2"])
+def test_faces_are_the_chordless_cycles(name):
+    # The faces are exactly the 4-cycles the old search finds, minus the ones with an edge through them
+    graph = linesToPlanarGraph(lsd(cv.imread(f'generated_images/{name}.png'), 2, scale=0.5))
+    expected = set()
+    for start in graph.vertex_indices().tolist():
+        for corners, path in _searchCycles(graph, start, [start], [start]):
+            chorded = any(abs(path.index(a) - path.index(b)) not in (1, len(path) - 1)
+                          for a in path for b in graph.get_neighbors(a) if b in path)
+            if not chorded:
+                expected.add(_faceKey(graph.positions[corners]))
+    assert {_faceKey(face) for face in getFaces(graph)} == expected
+
+if __name__ == "__main__":
+    test_shallow_corner_quad()
+    test_sc_cube_faces()
+    print("ok")
@@ -0,0 +1,29 @@
+import cv2 as cv
+import numpy as np
+import pytest
+from graph import Graph, connectIntersectingEdges, getFaces, mergeOverlappingVertices
+from opencv import lsd, linesToPlanarGraph, getCubes
+
+def test_crossing_past_both_ends():
+    # The edges only cross once both are extended, so neither is split
+    g = Graph()
+    a, b, c, d = g.add_vertices([(0, 0), (10, 0), (12, -5), (12, -1)])
+    g.add_edges([(a, b), (c, d)])
+    g = connectIntersectingEdges(g, threshold_detect=7, threshold_splice=0)
+    assert g.vertex_count == 4 and g.edge_count == 2
+
+def test_merge_keeps_connected_apart():
+    # 0 and 2 merge, 1 is as close to 2 but connected to 0 so it stays apart
+    g = Graph()
+    g.add_vertices([(0, 0), (6, 0), (3, 3), (3, 50)])
+    g.add_edges([(0, 1), (2, 3)])
+    g = mergeOverlappingVertices(g, threshold=9, neighbor_limit=1)
+    assert g.vertex_count == 3 and g.edge_count == 2
+    assert g.is_neighbor(0, 1)
+
+@pytest.mark.parametrize("name", ["sc_bugged", "sc_floating"])
+def test_crossings_without_splits(name):
+    # These frames have crossings where no edge gets split
+    lines = lsd(cv.imread(f'generated_images/{name}.png'), 2, scale=0.5)
+    assert len(getFaces(linesToPlanarGraph(lines))) > 0
+    assert len(getCubes(lines)) > 0
@@ -0,0 +1,14 @@
+import cv2 as cv
+import numpy as np
+from opencv import lsd, getCubes, edgeDistanceMap, cubeFitScores, verifyPoses
+
+def test_verify_rejects_moved_pose():
+    # The best face pose of the lone cube passes, the same pose half a cube to the side doesn't
+    image = cv.imread('generated_images/sc_cube.png')
+    lines = lsd(image, 2, scale=0.5)
+    distance_map = edgeDistanceMap(image.shape, lines)
+    trans = getCubes(lines)
+    rvec, tvec = trans[np.argmax(cubeFitScores(distance_map, trans))]
+    moved = np.ravel(tvec) + [0.5, 0, 0]
+    assert len(verifyPoses([(rvec, tvec)], distance_map)) == 1
+    assert len(verifyPoses([(rvec, moved)], distance_map)) == 0
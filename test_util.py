@@ -0,0 +1,28 @@
+import numpy as np
+from util import SegmentGrid, _crossWithin
+
+def _bruteForceCrossings(segments, threshold):
+    first, second = np.triu_indices(len(segments), 1)
+    crossing = _crossWithin(segments[first], segments[second], threshold)
+    return {(i, j) for i, j in zip(first[crossing].tolist(), second[crossing].tolist())}
+
+def test_extended_parallel_crossing():
+    # Each segment needs most of the threshold to reach the crossing, they are almost 2 * threshold apart
+    segments = np.array([[[-100, 0], [9.99, 0]], [[149.5, 1.2], [49.5, 0.199]]])
+    assert _crossWithin(segments[0], segments[1], 20)
+    grid = SegmentGrid(segments, cell_size=10)
+    assert grid.crossing_pairs(20).tolist() == [[0, 1]]
+    assert grid.crossing(segments[0], 20).tolist() == [1]
+
+def test_crossings_match_brute_force():
+    random = np.random.RandomState(0)
+    for threshold in [0, 5, 20]:
+        starts = random.rand(300, 2) * 400
+        directions = random.randn(300, 2)
+        segments = np.stack([starts, starts + directions / np.linalg.norm(directions, axis=1, keepdims=True) * random.rand(300, 1) * 80], axis=1)
+        grid = SegmentGrid(segments, cell_size=10)
+        expected = _bruteForceCrossings(segments, threshold)
+        assert set(map(tuple, grid.crossing_pairs(threshold).tolist())) == expected
+        for i in range(0, 300, 30):
+            crossing = {tuple(sorted((i, j))) for j in grid.crossing(segments[i], threshold).tolist() if j != i}
+            assert crossing == {pair for pair in expected if i in pair}
@@ -139,24 +139,65 @@ def combineEdges(line1, line2):
     return np.array([origin, origin + new_length * avg1])
 
 def combineParallelLines(lines, max_distance = 5, max_angle = 3):
-    new_lines = []
-    cancel = False
-    for i in range(len(lines)):
-        for j in range(i + 1, len(lines)):
-            if np.abs(np.dot(lines[i][1] - lines[i][0], lines[j][1] - lines[j][0])) / (np.linalg.norm(lines[i][1] - lines[i][0]) * np.linalg.norm(lines[j][1] - lines[j][0])) > np.cos(np.radians(max_angle)):
-                if edgeDistance(lines[i], lines[j]) < max_distance:
-                    new_lines = new_lines + [combineEdges(lines[i], lines[j])] + lines[i+1:j] + lines[j+1:]
-                    cancel = True
-            
-            if cancel:
-                break
-        if cancel:
-            break        
-        new_lines.append(lines[i])
-
-    if cancel:
-        return combineParallelLines(new_lines)
-    return new_lines
+    """
+    Combines nearly parallel edges that touch into single edges, returning an (N,2,2) array.
+    Edges within max_angle degrees of each other whose endpoints come closer than max_distance are clustered
+    with union-find, then every cluster is combined at once the same way combineEdges combines a pair.
+    A combined edge can reach edges its parts didn't, so passes repeat until nothing is combined.
+    """
+    segments = SegmentArray(lines).data
+    while len(segments) >= 2:
+        combined = _combineParallelPass(segments, max_distance, max_angle)
+        if len(combined) == len(segments):
+            break
+        segments = combined
+    return segments.copy()
+
+def _combineParallelPass(segments, max_distance, max_angle):
+    # Only edges sharing grid cells can be close enough to combine.
+    pairs = SegmentGrid(segments, cell_size=max(max_distance, 1)).candidate_pairs(max_distance)
+    a, b = segments[pairs[:, 0]], segments[pairs[:, 1]]
+    pairs = pairs[(segmentCosines(a, b) > np.cos(np.radians(max_angle))) & (edgeDistances(a, b) < max_distance)]
+    roots = unionFind(len(segments), pairs)
+    _, cluster = np.unique(roots, return_inverse=True)
+
+    # Make all the edges of a cluster face the same direction as its first edge
+    vectors = segments[:, 1] - segments[:, 0]
+    flip = np.sum(vectors * vectors[roots], axis=1) < 0
+    starts = np.where(flip[:, None], segments[:, 1], segments[:, 0])
+    ends = np.where(flip[:, None], segments[:, 0], segments[:, 1])
+    avg = np.zeros((cluster.max() + 1, 2))
+    np.add.at(avg, cluster, ends - starts)
+
+    # The combined edge starts at the start point furthest back along the average direction,
+    # and reaches as far as the furthest end point.
+    avg_squared = np.sum(avg * avg, axis=1)[cluster]
+    start_t = np.sum((starts - starts[roots]) * avg[cluster], axis=1) / avg_squared
+    end_t = np.sum((ends - starts[roots]) * avg[cluster], axis=1) / avg_squared
+    order = np.lexsort((start_t, cluster))
+    origin = order[np.searchsorted(cluster[order], np.arange(len(avg)))]
+    max_end_t = np.full(len(avg), -np.inf)
+    np.maximum.at(max_end_t, cluster, end_t)
+    new_lengths = max_end_t - start_t[origin]
+    return np.stack([starts[origin], starts[origin] + new_lengths[:, None] * avg], axis=1)
+
+def unionFind(count, pairs):
+    """
+    Connected components of count items joined by (P,2) index pairs.
+    Returns the smallest index of each item's component (its root).
+    """
+    roots = np.arange(count)
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    while True:
+        # Hook every item to the smallest root across its pairs, then compress the paths.
+        new_roots = roots.copy()
+        np.minimum.at(new_roots, pairs[:, 0], roots[pairs[:, 1]])
+        np.minimum.at(new_roots, pairs[:, 1], roots[pairs[:, 0]])
+        np.minimum.at(new_roots, roots, new_roots)
+        new_roots = new_roots[new_roots]
+        if np.array_equal(new_roots, roots):
+            return roots
+        roots = new_roots
 
 
 def pointInConvexPolygon(point, polygon):
@@ -167,6 +208,14 @@ def pointInConvexPolygon(point, polygon):
         return True
     return all(0 <= sign * get_side(point, [polygon[i], polygon[i+1]]) for i in range(1, len(polygon) - 1))
 
+def pointsInConvexPolygons(points, polygons):
+    """pointInConvexPolygon broadcast over (...,2) points and (...,V,2) polygons, checking every edge"""
+    points = np.asarray(points, dtype=np.float64)[..., None, :]
+    polygons = np.asarray(polygons, dtype=np.float64)
+    edges = np.roll(polygons, -1, axis=-2) - polygons
+    sides = (points[..., 0] - polygons[..., 0]) * edges[..., 1] - (points[..., 1] - polygons[..., 1]) * edges[..., 0]
+    return (sides >= 0).all(axis=-1) | (sides <= 0).all(axis=-1)
+
 def faceCircumference(face):
     return sum(np.linalg.norm(np.array(face[i])-face[i+1]) for i in range(-1,len(face) - 1))
 
@@ -266,6 +315,295 @@ def point_segment_distance(point, a1, a2):
 
   return math.hypot(dx, dy)
 
+#
+#   Batched segment geometry
+#   Segments are (..., 2, 2) arrays: [..., endpoint, coordinate]. All the functions broadcast over the leading axes,
+#   so a[:, None] against b[None, :] gives all pairs, and a[i] against b[j] gives chosen pairs.
+#
+
+DEFAULT_BLOCK_SIZE = 512
+
+def segmentParams(a, b):
+    """
+    Fractions (t, u) along a and b where the lines through them cross (nan for parallel segments).
+    Same values as _segmentIntersection and get_segments_intersection.
+    """
+    da = a[..., 1, :] - a[..., 0, :]
+    db = b[..., 1, :] - b[..., 0, :]
+    diff = b[..., 0, :] - a[..., 0, :]
+    bottom = da[..., 0] * db[..., 1] - da[..., 1] * db[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bottom = np.where(bottom == 0, np.nan, bottom)
+        t = (diff[..., 0] * db[..., 1] - diff[..., 1] * db[..., 0]) / bottom
+        u = (diff[..., 0] * da[..., 1] - diff[..., 1] * da[..., 0]) / bottom
+    return t, u
+
+def pointSegmentDistances(points, segments):
+    """Batched point_segment_distance"""
+    p1 = segments[..., 0, :]
+    direction = segments[..., 1, :] - p1
+    length_squared = np.sum(direction * direction, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.sum((points - p1) * direction, axis=-1) / length_squared
+    t = np.clip(np.nan_to_num(t, nan=0), 0, 1)
+    return np.linalg.norm(points - (p1 + t[..., None] * direction), axis=-1)
+
+def edgeDistances(a, b):
+    """Batched edgeDistance, the closest an endpoint of one segment gets to the other segment"""
+    return np.minimum(np.minimum(pointSegmentDistances(a[..., 0, :], b), pointSegmentDistances(a[..., 1, :], b)),
+                      np.minimum(pointSegmentDistances(b[..., 0, :], a), pointSegmentDistances(b[..., 1, :], a)))
+
+def segmentDistances(a, b):
+    """Batched segments_distance, zero for crossing segments"""
+    t, u = segmentParams(a, b)
+    crossing = (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    return np.where(crossing, 0, edgeDistances(a, b))
+
+def segmentCosines(a, b, absolute = True):
+    """Cosine of the angle between segments, by default ignoring their direction"""
+    da = a[..., 1, :] - a[..., 0, :]
+    db = b[..., 1, :] - b[..., 0, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.sum(da * db, axis=-1) / (np.linalg.norm(da, axis=-1) * np.linalg.norm(db, axis=-1))
+    return np.abs(cos) if absolute else cos
+
+class SegmentArray:
+    """
+    N segments in one (N,2,2) float array, with all-pairs geometry done in numpy.
+    The all-pairs methods take block_size to work through the rows in chunks, which bounds the temporaries
+    to block_size * M per chunk instead of N * M.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, segments):
+        if isinstance(segments, SegmentArray):
+            segments = segments.data
+        self.data = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index) -> 'SegmentArray':
+        return SegmentArray(self.data[index])
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __array__(self, dtype = None):
+        return self.data if dtype is None else self.data.astype(dtype)
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self.data[:, 0]
+
+    @property
+    def ends(self) -> np.ndarray:
+        return self.data[:, 1]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.data[:, 1] - self.data[:, 0]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.linalg.norm(self.vectors, axis=1)
+
+    def points_at(self, t) -> np.ndarray:
+        """Points at fraction t along each segment"""
+        return self.data[:, 0] + np.asarray(t)[..., None] * self.vectors
+
+    def blocks(self, block_size = DEFAULT_BLOCK_SIZE):
+        """Yield (start, stop) row ranges of at most block_size segments"""
+        block_size = len(self) if block_size is None else block_size
+        for start in range(0, len(self), max(block_size, 1)):
+            yield start, min(start + block_size, len(self))
+
+    def _all_pairs(self, func, other, block_size, outputs = 1):
+        other = self if other is None else SegmentArray(other)
+        results = [np.empty((len(self), len(other))) for _ in range(outputs)]
+        b = other.data[None, :]
+        for start, stop in self.blocks(block_size):
+            values = func(self.data[start:stop, None], b)
+            values = values if outputs > 1 else (values,)
+            for result, value in zip(results, values):
+                result[start:stop] = value
+        return results if outputs > 1 else results[0]
+
+    def intersection_params(self, other = None, block_size = None):
+        """(N,M) matrices t, u of where each pair of lines cross, t along self and u along other"""
+        return tuple(self._all_pairs(segmentParams, other, block_size, outputs=2))
+
+    def distance_matrix(self, other = None, block_size = None) -> np.ndarray:
+        """(N,M) segment to segment distances, zero where they cross"""
+        return self._all_pairs(segmentDistances, other, block_size)
+
+    def edge_distance_matrix(self, other = None, block_size = None) -> np.ndarray:
+        """(N,M) endpoint to segment distances (edgeDistance semantics)"""
+        return self._all_pairs(edgeDistances, other, block_size)
+
+    def cos_matrix(self, other = None, absolute = True, block_size = None) -> np.ndarray:
+        """(N,M) cosines of the angles between the segments"""
+        return self._all_pairs(lambda a, b: segmentCosines(a, b, absolute), other, block_size)
+
+    def pairs_within(self, distance, other = None, block_size = DEFAULT_BLOCK_SIZE) -> np.ndarray:
+        """
+        (P,2) index pairs of segments at most distance apart, without ever holding the full distance matrix.
+        Against itself, only pairs i < j are returned.
+        """
+        symmetric = other is None
+        other = self if symmetric else SegmentArray(other)
+        pairs = []
+        for start, stop in self.blocks(block_size):
+            rows, cols = np.nonzero(segmentDistances(self.data[start:stop, None], other.data[None, :]) <= distance)
+            rows += start
+            if symmetric:
+                rows, cols = rows[rows < cols], cols[rows < cols]
+            pairs.append(np.stack([rows, cols], axis=1))
+        return np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+
+def stackSegments(*groups) -> np.ndarray:
+    """Concatenate lists / arrays of segments into one (N,2,2) array"""
+    return np.concatenate([SegmentArray(group).data for group in groups])
+
+_CELL_OFFSET = 1 << 20
+_CELL_STRIDE = 1 << 21
+
+def _cellKeys(cells):
+    """Pack integer (x, y) cells into single sortable int64 keys"""
+    cells = np.asarray(cells, dtype=np.int64)
+    return (cells[..., 0] + _CELL_OFFSET) * _CELL_STRIDE + (cells[..., 1] + _CELL_OFFSET)
+
+def _cellOffsets(radius):
+    """Key deltas of the (2r+1)^2 square of cells around a cell"""
+    steps = np.arange(-radius, radius + 1, dtype=np.int64)
+    return (steps[:, None] * _CELL_STRIDE + steps[None, :]).ravel()
+
+def _expandRanges(lo, hi):
+    """Concatenation of the ranges [lo[i], hi[i])"""
+    counts = hi - lo
+    total = counts.sum()
+    if total == 0:
+        return np.empty(0, dtype=np.int64), counts
+    starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    return starts + np.arange(total), counts
+
+def pointPairsWithin(points, radius, other = None) -> np.ndarray:
+    """
+    (P,2) index pairs of points closer than radius, found by hashing the points into radius sized cells.
+    Within one set only pairs i < j are returned, against other every (points index, other index) pair is.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    symmetric = other is None
+    other = points if symmetric else np.asarray(other, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0 or len(other) == 0 or radius <= 0:
+        return np.empty((0, 2), dtype=np.int64)
+    other_keys = _cellKeys(np.floor(other / radius))
+    order = np.argsort(other_keys, kind="stable")
+    other_keys = other_keys[order]
+    keys = _cellKeys(np.floor(points / radius))
+    pairs = []
+    for offset in _cellOffsets(1):
+        entries, counts = _expandRanges(np.searchsorted(other_keys, keys + offset, 'left'), np.searchsorted(other_keys, keys + offset, 'right'))
+        first = np.repeat(np.arange(len(points)), counts)
+        second = order[entries]
+        keep = first < second if symmetric else slice(None)
+        pairs.append(np.stack([first[keep], second[keep]], axis=1))
+    pairs = np.concatenate(pairs)
+    return pairs[np.linalg.norm(points[pairs[:, 0]] - other[pairs[:, 1]], axis=1) < radius]
+
+class SegmentGrid:
+    """
+    Uniform grid over a set of segments, answering "which segments are near / crossing this one"
+    by only testing the segments registered in the surrounding cells.
+    Every segment is registered in the cells of points sampled along it, at most cell_size apart.
+    """
+    __slots__ = ("segments", "cell_size", "_keys", "_indices")
+
+    def __init__(self, segments, cell_size = 10):
+        self.segments = SegmentArray(segments)
+        self.cell_size = float(cell_size)
+        indices, keys = self._sample_cells(self.segments.data)
+        entries = np.unique(np.stack([keys, indices], axis=1), axis=0) if len(keys) else np.empty((0, 2), dtype=np.int64)
+        self._keys = entries[:, 0]
+        self._indices = entries[:, 1]
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def _sample_cells(self, segments):
+        """(segment index, cell key) for points sampled along every segment"""
+        segments = np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+        lengths = np.linalg.norm(segments[:, 1] - segments[:, 0], axis=1)
+        samples = np.ceil(lengths / self.cell_size).astype(np.int64) + 1
+        indices = np.repeat(np.arange(len(segments)), samples)
+        steps = np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+        t = steps / np.maximum(np.repeat(samples, samples) - 1, 1)
+        points = segments[indices, 0] + t[:, None] * (segments[indices, 1] - segments[indices, 0])
+        return indices, _cellKeys(np.floor(points / self.cell_size))
+
+    def _radius(self, distance) -> int:
+        # Samples are at most half a cell from any point of their segment, so one extra ring covers the rounding.
+        return int(np.ceil(distance / self.cell_size)) + 1
+
+    def _lookup(self, keys) -> np.ndarray:
+        keys = np.unique(keys)
+        entries, _ = _expandRanges(np.searchsorted(self._keys, keys, 'left'), np.searchsorted(self._keys, keys, 'right'))
+        return np.unique(self._indices[entries])
+
+    def candidates(self, segment, distance = 0) -> np.ndarray:
+        """Indices of segments that may be within distance of segment (a superset, no exact test)"""
+        _, keys = self._sample_cells(segment)
+        return self._lookup((keys[:, None] + _cellOffsets(self._radius(distance))[None, :]).ravel())
+
+    def near(self, segment, distance) -> np.ndarray:
+        """Indices of segments at most distance from segment"""
+        segment = np.asarray(segment, dtype=np.float64).reshape(2, 2)
+        candidates = self.candidates(segment, distance)
+        return candidates[segmentDistances(segment[None], self.segments.data[candidates]) <= distance]
+
+    def crossing(self, segment, threshold = 0) -> np.ndarray:
+        """
+        Indices of segments crossing segment.
+        threshold: how many pixels both segments may be extended by to reach each other.
+        """
+        segment = np.asarray(segment, dtype=np.float64).reshape(2, 2)
+        # Both ends of the crossing may be extended, so crossing segments can be up to 2 * threshold apart
+        candidates = self.candidates(segment, 2 * threshold)
+        return candidates[_crossWithin(segment[None], self.segments.data[candidates], threshold)]
+
+    def candidate_pairs(self, distance = 0) -> np.ndarray:
+        """(P,2) index pairs i < j that share a neighbourhood of cells (a superset, no exact test)"""
+        pairs = []
+        for offset in _cellOffsets(self._radius(distance)):
+            targets = self._keys + offset
+            entries, counts = _expandRanges(np.searchsorted(self._keys, targets, 'left'), np.searchsorted(self._keys, targets, 'right'))
+            first = np.repeat(self._indices, counts)
+            second = self._indices[entries]
+            keep = first < second
+            pairs.append(first[keep] * len(self) + second[keep])
+        pairs = np.unique(np.concatenate(pairs)) if pairs else np.empty(0, dtype=np.int64)
+        return np.stack([pairs // max(len(self), 1), pairs % max(len(self), 1)], axis=1)
+
+    def pairs(self, distance) -> np.ndarray:
+        """(P,2) index pairs i < j of segments at most distance apart"""
+        pairs = self.candidate_pairs(distance)
+        data = self.segments.data
+        return pairs[segmentDistances(data[pairs[:, 0]], data[pairs[:, 1]]) <= distance]
+
+    def crossing_pairs(self, threshold = 0) -> np.ndarray:
+        """(P,2) index pairs i < j of crossing segments, either may be extended by threshold pixels"""
+        pairs = self.candidate_pairs(2 * threshold)
+        data = self.segments.data
+        return pairs[_crossWithin(data[pairs[:, 0]], data[pairs[:, 1]], threshold)]
+
+def _crossWithin(a, b, threshold = 0):
+    """Whether segments cross when both may be extended by threshold pixels (the _segmentIntersection test)"""
+    t, u = segmentParams(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slack_a = threshold / np.linalg.norm(a[..., 1, :] - a[..., 0, :], axis=-1)
+        slack_b = threshold / np.linalg.norm(b[..., 1, :] - b[..., 0, :], axis=-1)
+    return (t >= -slack_a) & (t <= 1 + slack_a) & (u >= -slack_b) & (u <= 1 + slack_b)
+
 
 
 if __name__ == "__main__":